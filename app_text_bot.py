@@ -56,6 +56,8 @@ async def start_background_tasks(app):
     """在 Web 服务启动时后台运行 Bot"""
     text_bot = app['text_bot']
     app['bot_task'] = asyncio.create_task(text_bot.start())
+    # 订阅跨进程会话失效广播
+    app['message_service'].start_invalidation_listener()
 
 
 async def cleanup_background_tasks(app):
@@ -64,6 +66,15 @@ async def cleanup_background_tasks(app):
     await text_bot.stop()
     app['bot_task'].cancel()
     await app['bot_task']
+    # 等待 AI 调用遗留的后台清理任务（超时/落败提供方的连接关闭）
+    await app['ai_completion_port'].aclose_background_tasks()
+    # 停止会话失效监听，等待未完成的当日消息数缓存更新
+    await app['message_service'].aclose()
+    # 写完消息仓储批量队列中尚未落库的消息
+    await app['message_repository'].aclose()
+    # 写完 Redis 批量追加队列中尚未提交的消息
+    if app['redis_store'] is not None:
+        await app['redis_store'].aclose()
 
 
 def main() -> None:
@@ -115,6 +126,10 @@ def main() -> None:
         app = web.Application()
         app['text_bot'] = text_bot
         app['supabase_manager'] = supabase_manager
+        app['ai_completion_port'] = container.get("ai_completion_port")
+        app['message_repository'] = container.get("message_repository")
+        app['redis_store'] = container.get("redis_store")
+        app['message_service'] = container.get("message_service")
         
         # 注册路由
         app.router.add_get('/', health_check)
@@ -122,6 +122,9 @@ class BotApplication:
             # 启动Telegram Bot
             await self.telegram_bot.start()
             
+            # 启动过期订单定时清理
+            self.telegram_bot.payment_service.start_expired_order_cleanup()
+            
             self.logger.info("✅ Bot启动成功，等待用户消息...")
             self.logger.info(f"📊 配置信息:")
             self.logger.info(f"   - Bot Token: {'已配置' if self.settings.bot.token else '❌ 未配置'}")
@@ -147,6 +150,7 @@ class BotApplication:
             self.logger.info("🛑 正在停止应用...")
             
             if self.telegram_bot:
+                await self.telegram_bot.payment_service.stop_expired_order_cleanup()
                 await self.telegram_bot.stop()
                 self.logger.info("✅ Telegram Bot已停止")
             
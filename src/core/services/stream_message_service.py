@@ -1,9 +1,9 @@
 # stream_message_service.py - 流式消息处理服务（应用核心层）
 import time
-import json
+import orjson
 from datetime import datetime, timezone
 import logging
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Mapping, Optional
 from telegram import Update
 import re
 from src.infrastructure.monitoring.metrics import (
@@ -188,7 +188,7 @@ class StreamMessageService:
             def _on_used_instructions(meta: dict) -> None:
                 try:
                     used_instructions_meta.clear()
-                    if isinstance(meta, dict):
+                    if isinstance(meta, Mapping):
                         used_instructions_meta.update(meta)
                 except Exception as _e:
                     self.logger.debug(f"on_used_instructions 回调处理失败: {_e}")
@@ -272,10 +272,10 @@ class StreamMessageService:
                             final_messages = constructed
                         # 仅将 final_messages 作为 JSON 字符串写入 history，model_name 单独写入字段
                         try:
-                            history_json_str = json.dumps(final_messages, ensure_ascii=False)
+                            history_json_str = orjson.dumps(final_messages).decode()
                         except Exception:
                             # 兜底序列化
-                            history_json_str = json.dumps({"fallback": True}, ensure_ascii=False)
+                            history_json_str = '{"fallback": true}'
                         
                         # 🆕 新字段写入逻辑：round（以 session 维度的用户消息序号计算）
                         try:
@@ -303,7 +303,7 @@ class StreamMessageService:
                                     
                                     if user_id:
                                         # 异步保存用户消息（不阻塞主流程）
-                                        message_service.message_repository.save_user_message_with_real_instructions_async(
+                                        message_service.save_user_round_async(
                                             user_id=str(user_id),
                                             role_id=str(role_id) if role_id else None,
                                             session_id=session_id,
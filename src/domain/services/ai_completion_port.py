@@ -2,20 +2,35 @@
 import time
 import random
 import os
-import copy
+import logging
 import asyncio
-from typing import Optional, Callable, AsyncGenerator, Dict, Any, List
-from dataclasses import dataclass
+import contextlib
+from types import MappingProxyType
+from typing import Optional, Callable, AsyncGenerator, Dict, Any, List, Mapping, NamedTuple, Set
+from dataclasses import dataclass, field
+from async_timeout import timeout as _aio_timeout
 from demo.grok_async import AsyncGrokCaller
 from demo.novel_async import AsyncNovelCaller
 from demo.gemini_async import AsyncGeminiCaller
 from demo.deepseek_async import AsyncDeepseekCaller
+from src.utils.enhance import enhance_user_input
 from src.infrastructure.monitoring.metrics import (
     AI_PROVIDER_CALLS_TOTAL,
     AI_PROVIDER_CALLS_FAILED_TOTAL,
     AI_FIRST_TOKEN_LATENCY
 )
 
+logger = logging.getLogger(__name__)
+
+
+def _safe_emit(callback: Callable[[Mapping[str, Any]], None], meta: Dict[str, Any], stage: str = "") -> None:
+    """以只读视图回调指令元数据；回调异常统一在此记录，不影响流式生成"""
+    try:
+        callback(MappingProxyType(meta))
+    except Exception as _e:
+        label = f"on_used_instructions ({stage})" if stage else "on_used_instructions"
+        logger.warning(f"⚠️ {label} 回调执行失败: {_e}")
+
 @dataclass
 class CallProfile:
     """定义单次AI调用的配置规格"""
@@ -25,6 +40,90 @@ class CallProfile:
     provider_name: str     # 用于日志和监控显示的名称
     default_timeout: float = 3.0 # 默认超时时间
     default_model: str = None    # 默认模型名称（当环境变量未设置时使用）
+    # 以下字段由 resolve() 在初始化时从环境变量解析一次，避免每次重试重复读取
+    model: Optional[str] = field(default=None, init=False)
+    first_chunk_timeout: float = field(default=3.0, init=False)
+    # 预先绑定好标签的监控指标子对象，避免每次尝试重复 .labels(...) 查找
+    calls_total_metric: Any = field(default=None, init=False, repr=False)
+    first_token_latency_metric: Any = field(default=None, init=False, repr=False)
+    _failed_metrics: Dict[str, Any] = field(default_factory=dict, init=False, repr=False)
+
+    def resolve(self) -> "CallProfile":
+        """从环境变量解析模型名称与首字超时（进程级配置，运行期不变）"""
+        # 如果环境变量未设置，使用 profile 定义的默认值
+        self.model = os.getenv(self.model_env_key) or self.default_model
+
+        timeout_env_val = os.getenv(self.timeout_env_key)
+        try:
+            self.first_chunk_timeout = float(timeout_env_val) if timeout_env_val else self.default_timeout
+        except ValueError:
+            logger.warning(f"⚠️ {self.timeout_env_key} 配置无效，使用默认值 {self.default_timeout} 秒")
+            self.first_chunk_timeout = self.default_timeout
+
+        model_label = self.model or "unknown"
+        self.calls_total_metric = AI_PROVIDER_CALLS_TOTAL.labels(provider=self.provider_name, model=model_label)
+        self.first_token_latency_metric = AI_FIRST_TOKEN_LATENCY.labels(provider=self.provider_name, model=model_label)
+        self._failed_metrics.clear()
+        return self
+
+    def failed_metric(self, error_type: str) -> Any:
+        """按错误类型获取（首次使用时创建并缓存）失败计数指标"""
+        metric = self._failed_metrics.get(error_type)
+        if metric is None:
+            metric = AI_PROVIDER_CALLS_FAILED_TOTAL.labels(provider=self.provider_name, error_type=error_type)
+            self._failed_metrics[error_type] = metric
+        return metric
+
+class _PlanStep(NamedTuple):
+    """执行计划中的一步：调用配置 + 已解析的调用器实例"""
+    profile: CallProfile
+    caller: Optional[object]
+
+@dataclass(slots=True)
+class _AttemptState:
+    """单次 AI 调用尝试的状态，提供给 _stream_managed / generate_reply_stream 的回调均为其方法"""
+    profile: CallProfile
+    attempt_count: int
+    ai_req_start: float
+    on_used_instructions: Optional[Callable[[Mapping[str, Any]], None]] = None
+    meta: Dict[str, Any] = field(default_factory=dict)
+    chars: int = 0
+    metric_recorded: bool = False
+
+    # 追踪累积字符数，以实现"前5个字符"的Latency记录（与 Bot 侧体验指标对齐）
+    METRIC_CHAR_THRESHOLD = 5
+
+    def capture_used_instructions(self, meta: Dict[str, Any]) -> None:
+        self.meta.clear()
+        self.meta.update(meta or {})
+        self.meta["provider"] = self.profile.provider_name
+        self.meta["model"] = self.profile.model
+        self.meta["attempt_count"] = self.attempt_count  # 🆕 记录这是第几次尝试
+
+    def track_chunk(self, chunk_text: str) -> bool:
+        """返回 True 表示首响指标已记录，_stream_managed 之后不再回调本函数"""
+        if self.metric_recorded:
+            return True
+
+        # 累加字符
+        self.chars += len(chunk_text)
+
+        # 如果满足条件（字符数>=阈值），则记录指标
+        if self.chars >= self.METRIC_CHAR_THRESHOLD:
+            # ⏱️ T1: 记录 AI "首响"(前5字符)耗时
+            self.profile.first_token_latency_metric.observe(time.time() - self.ai_req_start)
+
+            # 触发指令元数据回调（在首响达成时触发一次即可）
+            if self.on_used_instructions and self.meta:
+                _safe_emit(self.on_used_instructions, self.meta)
+
+            self.metric_recorded = True
+        return self.metric_recorded
+
+    def on_duration(self, duration: float) -> None:
+        """接收 _stream_managed 计算出的完整生成时长"""
+        self.meta["full_response_latency"] = duration
+        logger.debug(f"⏱️ 完整生成耗时: {duration:.2f}s")
 
 class AICompletionPort:
     def __init__(self, 
@@ -43,19 +142,9 @@ class AICompletionPort:
         self.deepseek_3 = deepseek_caller_3
         # 保持对旧代码的兼容性 (如果仍有直接访问 self.deepseek 的情况)
         self.deepseek = deepseek_caller_1
+        # 默认调用器优先级链：DeepSeek -> Gemini -> Novel -> Grok
+        self._default_caller_chain = (self.deepseek_1, self.gemini, self.novel, self.grok)
 
-        # 前3轮对话的增强指令模板
-        self.early_conversation_instruction = (
-            "##系统指令：以下为最高优先级指令。\n"
-            "{system_instructions}"
-            "##用户指令:{user_context}\n"
-        )
-        # 第4轮及以后对话的持续指令模板
-        self.ongoing_conversation_instruction = (
-            "##系统指令：\n"
-            "{ongoing_instructions}"
-            "#用户指令:{user_context}\n"
-        )
         # 取消实例级共享状态，改为通过回调向调用方传递本次使用的指令信息
         # self.last_used_instructions 已移除
 
@@ -115,6 +204,9 @@ class AICompletionPort:
             ),
         }
 
+        for profile in self.profiles.values():
+            profile.resolve()
+
         # -------------------------------------------------------------------------
         # 2. 策略路由表 (Strategy Map): 定义不同模式下的调用链顺序
         # -------------------------------------------------------------------------
@@ -129,12 +221,21 @@ class AICompletionPort:
             "immersive": ["deepseek_v3", "deepseek_v2", "grok_v1"]
         }
 
+        # 3. 执行计划：策略链 -> (配置, 调用器实例) 步骤元组（仅包含有效的配置），初始化时解析一次
+        self._execution_plans = {
+            mode: tuple(
+                _PlanStep(self.profiles[key], getattr(self, self.profiles[key].caller_attr, None))
+                for key in keys if key in self.profiles
+            )
+            for mode, keys in self.strategies.items()
+        }
+
         # AI流式生成 - 2. 中间卡顿熔断时长 (默认3.0秒)
         inter_chunk_timeout_str = os.getenv("AI_STREAM_INTER_CHUNK_TIMEOUT")
         try:
             self.stream_inter_chunk_timeout = float(inter_chunk_timeout_str) if inter_chunk_timeout_str else 3.0
         except (TypeError, ValueError):
-            print("⚠️ AI_STREAM_INTER_CHUNK_TIMEOUT 配置无效，使用默认值 3.0 秒")
+            logger.warning("⚠️ AI_STREAM_INTER_CHUNK_TIMEOUT 配置无效，使用默认值 3.0 秒")
             self.stream_inter_chunk_timeout = 3.0
 
         # AI流式生成 - 3. 总时长熔断 (默认15.0秒)
@@ -142,35 +243,59 @@ class AICompletionPort:
         try:
             self.stream_total_timeout = float(total_timeout_str) if total_timeout_str else 15.0
         except (TypeError, ValueError):
-            print("⚠️ AI_STREAM_TOTAL_TIMEOUT 配置无效，使用默认值 15.0 秒")
+            logger.warning("⚠️ AI_STREAM_TOTAL_TIMEOUT 配置无效，使用默认值 15.0 秒")
             self.stream_total_timeout = 15.0
 
+        # 后台清理任务（超时/落败提供方的生成器关闭），不阻塞下一次尝试或胜者输出
+        self._bg_tasks: Set[asyncio.Task] = set()
 
+        # 调试开关：故障注入概率（默认0，生产环境关闭；测试环境可设为 0.01 演练重试链路）
+        fault_rate_str = os.getenv("AI_FAULT_INJECT_RATE")
+        try:
+            self._fault_inject_rate = float(fault_rate_str) if fault_rate_str else 0.0
+        except (TypeError, ValueError):
+            logger.warning("⚠️ AI_FAULT_INJECT_RATE 配置无效，关闭故障注入")
+            self._fault_inject_rate = 0.0
+        self._fault_rng = random.Random()
 
-    def _safe_for_logging(self, text: str, max_len: Optional[int] = None) -> str:
-        """Return a logging-safe preview of text, avoiding Unicode surrogate errors.
+        # 调试开关：是否在指令元数据中额外记录完整的 prompt_payload（默认关闭）
+        self.capture_prompt_payload = os.getenv("AI_CAPTURE_PROMPT_PAYLOAD", "0") == "1"
 
-        - Truncates to max_len if provided
-        - Replaces unencodable characters with Python-style backslash escapes
-        """
+        # AI流式生成 - 4. 对冲请求延迟 (默认0，即关闭对冲)
+        # 首个提供方超过该时长仍无首响时，并行发起策略链中的第二个提供方，先出首响者胜出
+        hedge_delay_str = os.getenv("AI_STREAM_HEDGE_DELAY")
         try:
-            if text is None:
-                return ""
-            if max_len is not None:
-                text = text[:max_len]
-            # backslashreplace ensures surrogates or other problematic code points won't crash stdout
-            return text.encode('utf-8', 'backslashreplace').decode('utf-8', 'strict')
-        except Exception:
-            return "<unprintable>"
+            self.stream_hedge_delay = float(hedge_delay_str) if hedge_delay_str else 0.0
+        except (TypeError, ValueError):
+            logger.warning("⚠️ AI_STREAM_HEDGE_DELAY 配置无效，关闭对冲请求")
+            self.stream_hedge_delay = 0.0
+        # 启用对冲的模式（immersive 使用重型模型，默认保持串行）
+        hedge_modes_str = os.getenv("AI_STREAM_HEDGE_MODES", "fast,story")
+        self.stream_hedge_modes = frozenset(m.strip() for m in hedge_modes_str.split(",") if m.strip())
+
 
 
+    def _get_role_prefix(self, role_data, include_preset: bool) -> List[Dict[str, Any]]:
+        """
+        构建角色的固定消息前缀（system_prompt + 可选的角色预置对话）
+
+        role_data 每次请求都从数据库重新读取，没有可廉价比对的版本号，
+        直接按当前内容构建（只是浅拷贝消息引用，开销与比对缓存相当）。
+        """
+        prefix = []
+        if "system_prompt" in role_data:
+            prefix.append({"role": "system", "content": role_data["system_prompt"]})
+        if include_preset and "history" in role_data:
+            prefix.extend(role_data["history"])
+        return prefix
+
     def _count_real_user_turns(self, history):
         """
         统计会话中真实用户发言轮次
         只统计 role == "user" 的消息数量
         """
         user_turns = sum(1 for msg in history if msg.get("role") == "user")
-        print(f"📊 统计用户对话轮次: {user_turns}")
+        logger.debug(f"📊 统计用户对话轮次: {user_turns}")
         return user_turns
     
     def _find_last_user_message_index(self, messages):
@@ -178,11 +303,15 @@ class AICompletionPort:
         找到消息列表中最后一条用户消息的索引
         从后往前查找，返回最后一条 role == "user" 的消息索引
         """
-        for i in range(len(messages) - 1, -1, -1):
-            if messages[i].get("role") == "user":
-                print(f"🔍 找到最后一条用户消息位置: index={i}")
-                return i
-        print("⚠️ 未找到用户消息")
+        # 快速路径：刚追加的用户消息通常就在末尾
+        if messages and messages[-1].get("role") == "user":
+            return len(messages) - 1
+        last_index = len(messages) - 1
+        for offset, msg in enumerate(reversed(messages)):
+            if msg.get("role") == "user":
+                logger.debug(f"🔍 找到最后一条用户消息位置: index={last_index - offset}")
+                return last_index - offset
+        logger.warning("⚠️ 未找到用户消息")
         return None
     
     def _enhance_user_message_with_instruction(self, original_content, user_context="当前对话", instruction_type="system"):
@@ -198,12 +327,11 @@ class AICompletionPort:
             tuple: (增强后的消息内容, 使用的指令内容)
         """
         # 代理到公共 util，保持单一实现
-        from src.utils.enhance import enhance_user_input
         enhanced_content, instructions = enhance_user_input(original_content, instruction_type, user_context=user_context)
-        print(f"✨ 用户消息已增强({instruction_type}) | 原长度: {len(original_content)} | 增强后长度: {len(enhanced_content)}")
+        logger.debug(f"✨ 用户消息已增强({instruction_type}) | 原长度: {len(original_content)} | 增强后长度: {len(enhanced_content)}")
         return enhanced_content, instructions if instructions else None
 
-    async def generate_reply_stream(self, role_data, history, user_input, timeout=60, session_context_source=None, caller: Optional[object] = None, model_name: Optional[str] = None, on_used_instructions: Optional[Callable[[Dict[str, Any]], None]] = None, apply_enhancement: bool = False, model_mode: str = "immersive") -> AsyncGenerator[str, None]:
+    async def generate_reply_stream(self, role_data, history, user_input, timeout=60, session_context_source=None, caller: Optional[object] = None, model_name: Optional[str] = None, on_used_instructions: Optional[Callable[[Mapping[str, Any]], None]] = None, apply_enhancement: bool = False, model_mode: str = "immersive", user_turn_count: Optional[int] = None) -> AsyncGenerator[str, None]:
         """
         流式生成AI回复 - 返回异步生成器，用于Telegram Bot的流式更新
         
@@ -213,36 +341,36 @@ class AICompletionPort:
             user_input: 当前用户指令
             timeout: 超时时间
             session_context_source: 会话上下文来源标记
-            on_used_instructions: 可选回调，携带本次调用实际使用的指令元数据（仅调用一次）
+            on_used_instructions: 可选回调，携带本次调用实际使用的指令元数据（只读视图，需保留时请自行拷贝；仅调用一次）
             apply_enhancement: 是否在本方法中对最后一条用户消息做指令增强（默认 False）
             model_mode: 模型等级/模式（immersive/story/fast）
+            user_turn_count: 可选，调用方已知的用户发言轮次；提供时不再扫描 history 统计
             
         Yields:
             str: 每个流式回复片段
         """
         # 打印输入的历史记录
-        print(f"🧠 AI流式生成回复 | 模式: {model_mode} | 输入历史记录数量: {len(history)} | 上下文来源: {session_context_source or '常规'}")
+        logger.info(f"🧠 AI流式生成回复 | 模式: {model_mode} | 输入历史记录数量: {len(history)} | 上下文来源: {session_context_source or '常规'}")
         
         # 构建 prompt（复用相同逻辑）
-        messages = []
-        history_for_prompt = copy.deepcopy(history or [])
+        # 浅拷贝即可：唯一的修改是增强时整体替换目标消息字典，不会原地改动调用方的消息
+        history_for_prompt = list(history) if history else []
         
         # 1. 添加 system_prompt
-        if "system_prompt" in role_data:
-            messages.append({"role": "system", "content": role_data["system_prompt"]})
-        
         # 2. 仅在非快照会话时添加角色预置 history（避免重复）
-        if session_context_source != "snapshot" and "history" in role_data:
-            messages.extend(role_data["history"])
-            print(f"✅ 添加角色预置对话: {len(role_data.get('history', []))} 条")
+        include_preset = session_context_source != "snapshot"
+        messages = self._get_role_prefix(role_data, include_preset)
+        if include_preset and "history" in role_data:
+            logger.debug(f"✅ 添加角色预置对话: {len(role_data.get('history', []))} 条")
         elif session_context_source == "snapshot":
-            print(f"⏭️ 跳过角色预置对话（快照会话已包含完整上下文）")
+            logger.debug(f"⏭️ 跳过角色预置对话（快照会话已包含完整上下文）")
         
         # 3. 添加实际会话历史（使用副本，避免污染原始记录）
         messages.extend(history_for_prompt)
         
         # 🆕 4. 对话增强指令逻辑（流式版本）
-        user_turn_count = self._count_real_user_turns(history)
+        if user_turn_count is None:
+            user_turn_count = self._count_real_user_turns(history or [])
         used_meta: Dict[str, Any] = {
             "turn_count": user_turn_count,
             "instruction_type": None,
@@ -251,52 +379,34 @@ class AICompletionPort:
             "model": model_name
         }
         
-        if user_turn_count <= 3 and messages:
-            # 前3轮：使用系统指令
-            last_user_msg_index = self._find_last_user_message_index(messages)
-            if last_user_msg_index is not None:
-                original_content = messages[last_user_msg_index]["content"]
-                enhanced_content, used_instruction = self._enhance_user_message_with_instruction(
-                    original_content, 
-                    original_content,
-                    instruction_type="system"
-                )
-                if apply_enhancement:
-                    messages[last_user_msg_index]["content"] = enhanced_content
-                used_meta["instruction_type"] = "system"
-                used_meta["system_instructions"] = used_instruction
-                # 🆕 新字段写入逻辑：记录本轮实际使用的指令（供上层存入 messages.instructions）
-                used_meta["instructions"] = used_instruction
-                if apply_enhancement:
-                    print(f"✅ 已为第{user_turn_count}轮对话添加系统增强指令（流式）")
-        elif user_turn_count >= 4 and messages:
-            # 第4轮及以后：使用持续指令
-            last_user_msg_index = self._find_last_user_message_index(messages)
-            if last_user_msg_index is not None:
-                original_content = messages[last_user_msg_index]["content"]
-                enhanced_content, used_instruction = self._enhance_user_message_with_instruction(
-                    original_content, 
-                    original_content,
-                    instruction_type="ongoing"
-                )
-                if apply_enhancement:
-                    messages[last_user_msg_index]["content"] = enhanced_content
-                used_meta["instruction_type"] = "ongoing"
-                used_meta["ongoing_instructions"] = used_instruction
-                # 🆕 新字段写入逻辑：记录本轮实际使用的指令（供上层存入 messages.instructions）
-                used_meta["instructions"] = used_instruction
-                if apply_enhancement:
-                    print(f"✅ 已为第{user_turn_count}轮对话添加持续增强指令（流式）")
+        # 前3轮使用系统指令，第4轮及以后使用持续指令
+        instruction_type = "system" if user_turn_count <= 3 else "ongoing"
+        last_user_msg_index = self._find_last_user_message_index(messages) if messages else None
+        if last_user_msg_index is not None:
+            original_content = messages[last_user_msg_index]["content"]
+            enhanced_content, used_instruction = self._enhance_user_message_with_instruction(
+                original_content, 
+                original_content,
+                instruction_type=instruction_type
+            )
+            if apply_enhancement:
+                # 替换为新字典而非原地修改，避免改动角色预置对话与调用方传入的历史
+                messages[last_user_msg_index] = {**messages[last_user_msg_index], "content": enhanced_content}
+                logger.debug(f"✅ 已为第{user_turn_count}轮对话添加{instruction_type}增强指令（流式）")
+            used_meta["instruction_type"] = instruction_type
+            used_meta[f"{instruction_type}_instructions"] = used_instruction
+            # 🆕 新字段写入逻辑：记录本轮实际使用的指令（供上层存入 messages.instructions）
+            used_meta["instructions"] = used_instruction
         
-        print(f"🔧 构建完整消息列表 | 总消息数: {len(messages)}")
-        print("🧠" + "="*48)
+        logger.debug(f"🔧 构建完整消息列表 | 总消息数: {len(messages)}")
 
-        # 模拟超时
-        if random.random() < 0.01:
+        # 模拟超时（故障注入，仅在配置了 AI_FAULT_INJECT_RATE 的环境中生效）
+        if self._fault_inject_rate and self._fault_rng.random() < self._fault_inject_rate:
             raise TimeoutError("4004: 生成超时")
 
         # 开始计时
-        start = time.time()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
         
         # 流式生成并逐步返回
         chunk_count = 0
@@ -310,73 +420,77 @@ class AICompletionPort:
         # 🆕 新字段写入逻辑：补充回调元数据（模型名与本次调用的上下文载荷）
         try:
             used_meta["model_name"] = model_name
-            # 100% 复现：记录本次实际投喂的完整 messages
-            used_meta["final_messages"] = list(messages)
-            used_meta["prompt_payload"] = {
-                "system_prompt": role_data.get("system_prompt") if isinstance(role_data, dict) else None,
-                "history": history_for_prompt,
-                "user_input": user_input,
-                "instructions": used_meta.get("instructions"),
-                "instruction_type": used_meta.get("instruction_type"),
-                # 兼容旧字段的同时，加入最终 messages
-                "final_messages": list(messages)
-            }
+            # 100% 复现：记录本次实际投喂的完整 messages（此后 messages 不再修改，共享同一引用）
+            used_meta["final_messages"] = messages
+            # 完整上下文载荷仅用于排查问题，没有运行期消费方，按调试开关按需记录
+            if self.capture_prompt_payload:
+                used_meta["prompt_payload"] = {
+                    "system_prompt": role_data.get("system_prompt") if isinstance(role_data, dict) else None,
+                    "history": history_for_prompt,
+                    "user_input": user_input,
+                    "instructions": used_meta.get("instructions"),
+                    "instruction_type": used_meta.get("instruction_type"),
+                    # 兼容旧字段的同时，加入最终 messages
+                    "final_messages": messages
+                }
         except Exception:
             pass
 
         # 在开始流式之前，回调一次提供指令使用的元数据
         if on_used_instructions and used_meta.get("instruction_type") is not None:
-            try:
-                on_used_instructions(dict(used_meta))
-            except Exception as _e:
-                print(f"⚠️ on_used_instructions 回调执行失败: {_e}")
+            _safe_emit(on_used_instructions, used_meta)
 
         async for partial_reply in use_caller.get_stream_response(messages, use_model, timeout=timeout):
             chunk_count += 1
             total_chars += len(partial_reply)
-            safe_chunk_preview = self._safe_for_logging(partial_reply, 50)
-            # print(f"🔄 收到chunk #{chunk_count}: {len(partial_reply)} 字符 | 内容预览: {safe_chunk_preview}...")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"🔄 收到chunk #{chunk_count}: {len(partial_reply)} 字符 | 内容预览: {self._safe_for_logging(partial_reply, 50)}")
             yield partial_reply
 
         # 结束流式生成
-        print(f"🤖 AI流式生成完成 | 耗时: {time.time() - start:.2f}秒 | 总chunk数: {chunk_count} | 总字符数: {total_chars}")
-        print("🤖" + "="*48)
+        logger.info(f"🤖 AI流式生成完成 | 耗时: {loop.time() - start:.2f}秒 | 总chunk数: {chunk_count} | 总字符数: {total_chars}")
 
-    async def _stream_managed(self, generator: AsyncGenerator[str, None], first_chunk_timeout: float, inter_chunk_timeout: float = 5.0, total_timeout: float = 20.0, on_chunk_received: Callable[[str], None] = None, provider_name: str = "Unknown", on_duration_calculated: Callable[[float], None] = None) -> AsyncGenerator[str, None]:
+    async def _stream_managed(self, generator: AsyncGenerator[str, None], first_chunk_timeout: float, inter_chunk_timeout: float = 5.0, total_timeout: float = 20.0, on_chunk_received: Callable[[str], Optional[bool]] = None, provider_name: str = "Unknown", on_duration_calculated: Callable[[float], None] = None) -> AsyncGenerator[str, None]:
         """
         全能流式包装器，实现三道防线超时控制：
         1. 首响超时 (TTFT): 抛出异常 -> 触发重试
         2. 中间卡顿: 停止生成 -> 视为成功
         3. 总时长超时: 停止生成 -> 视为成功
+
+        on_chunk_received 返回 True 表示其已完成（不再需要后续 chunk），之后不再调用。
         """
+        # 统一使用事件循环的单调时钟，避免系统时间跳变影响超时判断
+        loop = asyncio.get_running_loop()
         start_time = None
         is_first_chunk = True
         
         try:
             # Stage 1: First Chunk Timeout
             try:
-                first_chunk = await asyncio.wait_for(generator.__anext__(), timeout=first_chunk_timeout)
-                start_time = time.time()
-                if on_chunk_received:
-                    on_chunk_received(first_chunk)
+                # async_timeout 直接在当前任务上挂定时器，不像 wait_for 那样每次新建 Task
+                async with _aio_timeout(first_chunk_timeout):
+                    first_chunk = await generator.__anext__()
+                start_time = loop.time()
+                deadline = start_time + total_timeout
+                if on_chunk_received and on_chunk_received(first_chunk):
+                    on_chunk_received = None
                 yield first_chunk
                 is_first_chunk = False
             except asyncio.TimeoutError:
                 # 第一道防线：首响超时 -> 抛出异常，让上层去重试
-                await generator.aclose()
+                # 仍存活的生成器统一由下方 finally 放到后台关闭，不阻塞下一次尝试
                 raise TimeoutError(f"{provider_name} 首个chunk超时（超过{first_chunk_timeout}秒）")
             except StopAsyncIteration:
-                await generator.aclose()
+                # 生成器已自然结束，无需再关闭
                 raise RuntimeError(f"{provider_name} 未返回任何内容")
             
             # Stage 2 & 3: Inter-Chunk & Total Timeout
             while True:
-                # 计算剩余的总可用时间
-                elapsed = time.time() - start_time
-                remaining_total = total_timeout - elapsed
+                # 计算剩余的总可用时间（每轮只读取一次时钟）
+                remaining_total = deadline - loop.time()
                 
                 if remaining_total <= 0:
-                    print(f"⏱️ {provider_name} 达到总时长熔断阈值 ({total_timeout}s)，停止生成")
+                    logger.info(f"⏱️ {provider_name} 达到总时长熔断阈值 ({total_timeout}s)，停止生成")
                     break # 第三道防线：总时长超时 -> 正常结束
                 
                 # 计算本次 wait 的时间：取 Inter-Chunk 和 Remaining-Total 的较小值
@@ -384,52 +498,50 @@ class AICompletionPort:
                 wait_time = min(inter_chunk_timeout, remaining_total)
                 
                 try:
-                    chunk = await asyncio.wait_for(generator.__anext__(), timeout=wait_time)
-                    if on_chunk_received:
-                        on_chunk_received(chunk)
+                    async with _aio_timeout(wait_time):
+                        chunk = await generator.__anext__()
+                    if on_chunk_received and on_chunk_received(chunk):
+                        on_chunk_received = None
                     yield chunk
                 except asyncio.TimeoutError:
                     # 判断是哪种超时
-                    if time.time() - start_time >= total_timeout:
-                         print(f"⏱️ {provider_name} 达到总时长熔断阈值 ({total_timeout}s)，停止生成")
+                    if loop.time() >= deadline:
+                         logger.info(f"⏱️ {provider_name} 达到总时长熔断阈值 ({total_timeout}s)，停止生成")
                          break # 第三道防线
                     else:
-                         print(f"🐢 {provider_name} 中间生成卡顿（超过{inter_chunk_timeout}s），提前截断")
+                         logger.warning(f"🐢 {provider_name} 中间生成卡顿（超过{inter_chunk_timeout}s），提前截断")
                          break # 第二道防线：中间卡顿 -> 正常结束（截断）
                 except StopAsyncIteration:
                     break # 正常结束
 
         except Exception as e:
-            # 确保生成器被关闭
-            try:
-                await generator.aclose()
-            except:
-                pass
-            if isinstance(e, (TimeoutError, RuntimeError)) and is_first_chunk:
-                raise e # 首响相关的错误往上抛，触发重试
-            
-            # 其他错误（如网络中断），如果不是首响，也可以考虑截断而不是报错？
+            # 生成器抛出异常时自身已结束，这里不再重复 aclose，直接传播/截断
+            # 首响相关的错误（超时/无内容/网络异常）往上抛，触发重试
             if is_first_chunk:
-                 raise e
+                 raise
             else:
-                 print(f"⚠️ {provider_name} 生成过程中发生异常: {e}，视为截断")
-                 # 异常情况下，我们依然可以计算已消耗的时间
-                 pass
+                 # 其他错误（如网络中断），如果不是首响，视为截断而不是报错
+                 logger.warning(f"⚠️ {provider_name} 生成过程中发生异常: {e}，视为截断")
         
         finally:
+             # 生成器的唯一关闭点：仅当其仍未结束（首响超时、调用方提前中断迭代等）时放到后台关闭
+             if getattr(generator, "ag_frame", None) is not None:
+                 self._spawn_background(self._aclose_quietly(generator))
              # 在生成结束时，计算并回调实际时长
-             if start_time and on_duration_calculated:
-                 duration = time.time() - start_time
+             if start_time is not None and on_duration_calculated:
+                 duration = loop.time() - start_time
                  try:
                      on_duration_calculated(duration)
                  except Exception as _e:
-                     print(f"⚠️ on_duration_calculated 回调执行失败: {_e}")
+                     logger.warning(f"⚠️ on_duration_calculated 回调执行失败: {_e}")
 
     async def generate_reply_stream_with_retry(self, role_data, history, user_input, 
                                              max_retries=3, timeout=60, session_context_source=None,
-                                             on_used_instructions: Optional[Callable[[Dict[str, Any]], None]] = None,
+                                             on_used_instructions: Optional[Callable[[Mapping[str, Any]], None]] = None,
                                              apply_enhancement: bool = False,
-                                             model_mode: str = "immersive") -> AsyncGenerator[str, None]:
+                                             model_mode: str = "immersive",
+                                             user_turn_count: Optional[int] = None,
+                                             emit_on_first_token: bool = False) -> AsyncGenerator[str, None]:
         """
         带重试机制的流式生成AI回复
         
@@ -440,19 +552,24 @@ class AICompletionPort:
             max_retries: 最大重试次数，默认3次
             timeout: 超时时间
             session_context_source: 会话上下文来源标记
-            on_used_instructions: 可选回调，携带本次调用实际使用的指令元数据（仅在成功的那次尝试触发一次）
+            on_used_instructions: 可选回调，携带本次调用实际使用的指令元数据（只读视图，需保留时请自行拷贝；仅在成功的那次尝试结束时触发一次）
             apply_enhancement: 是否在本方法中对最后一条用户消息做指令增强（默认 False）
             model_mode: 模型等级/模式（immersive/story/fast）
+            user_turn_count: 可选，调用方已知的用户发言轮次（未提供时统计一次，各次重试复用）
+            emit_on_first_token: 是否在首响达成时额外回调一次 on_used_instructions（默认 False，
+                现有调用方均在流结束后才读取元数据，结束时的回调已包含完整信息）
             
         Yields:
             str: 每个流式回复片段
         """
-        # 1. 获取当前模式对应的策略链
-        # 默认兜底使用 immersive 策略
-        strategy_keys = self.strategies.get(model_mode, self.strategies["immersive"])
-        
-        # 2. 转换为具体的配置对象列表（仅包含有效的配置）
-        execution_plan = [self.profiles[key] for key in strategy_keys if key in self.profiles]
+        # 用户发言轮次与具体提供方无关，只统计一次供所有尝试复用
+        if user_turn_count is None:
+            user_turn_count = self._count_real_user_turns(history or [])
+
+        # 获取当前模式对应的执行计划（初始化时已解析），默认兜底使用 immersive 策略
+        execution_plan = self._execution_plans.get(model_mode)
+        if execution_plan is None:
+            execution_plan = self._execution_plans["immersive"]
 
         if not execution_plan:
              raise RuntimeError(f"策略 '{model_mode}' 未定义任何有效的执行计划")
@@ -460,154 +577,229 @@ class AICompletionPort:
         # 限制重试次数不超过计划长度
         total_attempts = min(max_retries, len(execution_plan))
 
-        for attempt in range(total_attempts):
-            profile = execution_plan[attempt]
-            
-            # 动态获取 caller 实例
-            caller = getattr(self, profile.caller_attr, None)
-            if not caller:
-                print(f"⚠️ 调用器 '{profile.caller_attr}' 未初始化，跳过此步骤")
+        # 对冲模式：首个提供方在 hedge_delay 内没有首响时，并行发起第二个提供方，先出首响者胜出
+        hedge = self.stream_hedge_delay > 0 and model_mode in self.stream_hedge_modes and total_attempts >= 2
+
+        stream_kwargs = dict(
+            role_data=role_data,
+            history=history,
+            user_input=user_input,
+            timeout=timeout,
+            session_context_source=session_context_source,
+            apply_enhancement=apply_enhancement,
+            model_mode=model_mode,
+            user_turn_count=user_turn_count
+        )
+
+        attempt = 0
+        while attempt < total_attempts:
+            # 本轮参与的尝试：常规为 1 个；对冲模式下首轮为策略链中的前两个
+            batch = range(attempt, min(attempt + (2 if hedge and attempt == 0 else 1), total_attempts))
+            attempt = batch.stop
+
+            contenders = []
+            for index in batch:
+                # caller 实例已在初始化时随执行计划解析
+                profile, caller = execution_plan[index]
+                if not caller:
+                    logger.warning(f"⚠️ 调用器 '{profile.caller_attr}' 未初始化，跳过此步骤")
+                    continue
+                contenders.append((index, profile, caller))
+            if not contenders:
                 continue
 
-            # 动态获取环境变量配置
-            model_env = os.getenv(profile.model_env_key)
-            # 如果环境变量未设置，使用 profile 定义的默认值
-            if not model_env and profile.default_model:
-                model_env = profile.default_model
-                
-            timeout_env_val = os.getenv(profile.timeout_env_key)
-            try:
-                first_chunk_timeout = float(timeout_env_val) if timeout_env_val else profile.default_timeout
-            except ValueError:
-                first_chunk_timeout = profile.default_timeout
+            if len(contenders) == 1:
+                index, profile, caller = contenders[0]
+                managed, used_meta_candidate = self._open_attempt(
+                    index, total_attempts, profile, caller,
+                    on_used_instructions if emit_on_first_token else None, stream_kwargs
+                )
+                try:
+                    async for chunk in managed:
+                        yield chunk
+                except Exception as e:
+                    self._record_attempt_failure(index, profile, e, total_attempts)
+                    continue
+            else:
+                won = await self._race_first_chunk(contenders, total_attempts, stream_kwargs)
+                if won is None:
+                    continue
+                index, profile, managed, used_meta_candidate, first_chunk = won
+                # 对冲期间不在首响时回调，胜出后仅为胜者补发一次
+                if emit_on_first_token and on_used_instructions and used_meta_candidate:
+                    _safe_emit(on_used_instructions, used_meta_candidate)
+                yield first_chunk
+                async for chunk in managed:
+                    yield chunk
 
-            provider_display_name = profile.provider_name
+            logger.info(f"✅ AI生成成功（第{index + 1}次尝试，提供方: {profile.provider_name}）")
 
-            try:
-                print(f"🔄 AI生成尝试 #{attempt + 1}/{total_attempts}")
-                print(f"🚀 本次尝试使用提供方: {provider_display_name} | 模型: {model_env} | 模式: {model_mode} | 首字超时: {first_chunk_timeout}s")
+            # 🆕 结束标志前，再次回调以透传最终时长
+            if on_used_instructions and used_meta_candidate:
+                _safe_emit(on_used_instructions, used_meta_candidate, stage="final")
 
-                # 📊 T0: 记录 AI 调用次数
-                AI_PROVIDER_CALLS_TOTAL.labels(provider=provider_display_name, model=model_env or "unknown").inc()
-                
-                # ⏱️ T1: 记录 AI 请求发起时间
-                ai_req_start = time.time()
-
-                used_meta_candidate: Dict[str, Any] = {}
-
-                def _capture_used_instructions(meta: Dict[str, Any]) -> None:
-                    used_meta_candidate.clear()
-                    used_meta_candidate.update(meta or {})
-                    used_meta_candidate["provider"] = provider_display_name
-                    used_meta_candidate["model"] = model_env
-                    used_meta_candidate["attempt_count"] = attempt + 1  # 🆕 记录这是第几次尝试
-
-                stream = self.generate_reply_stream(
-                    role_data=role_data,
-                    history=history,
-                    user_input=user_input,
-                    timeout=timeout,
-                    session_context_source=session_context_source,
-                    caller=caller,
-                    model_name=model_env,
-                    on_used_instructions=_capture_used_instructions,
-                    apply_enhancement=apply_enhancement,
-                    model_mode=model_mode
-                )
+            return
 
-                # 追踪累积字符数，以实现"前5个字符"的Latency记录（与 Bot 侧体验指标对齐）
-                accumulated_chars_count = 0
-                metric_recorded = False
-                METRIC_CHAR_THRESHOLD = 5
-
-                def _track_chunk_and_record_metric(chunk_text: str) -> None:
-                    nonlocal accumulated_chars_count, metric_recorded
-                    
-                    if metric_recorded:
-                        return
-
-                    # 累加字符
-                    accumulated_chars_count += len(chunk_text)
-                    
-                    # 如果满足条件（字符数>=阈值），则记录指标
-                    if accumulated_chars_count >= METRIC_CHAR_THRESHOLD:
-                        # ⏱️ T1: 记录 AI "首响"(前5字符)耗时
-                        latency = time.time() - ai_req_start
-                        AI_FIRST_TOKEN_LATENCY.labels(provider=provider_display_name, model=model_env or "unknown").observe(latency)
-                        
-                        # 触发指令元数据回调（在首响达成时触发一次即可）
-                        if on_used_instructions and used_meta_candidate:
-                            try:
-                                on_used_instructions(dict(used_meta_candidate))
-                            except Exception as _e:
-                                print(f"⚠️ on_used_instructions 回调执行失败: {_e}")
-                        
-                        metric_recorded = True
-                
-                # 定义接收时长数据的回调
-                def _on_duration_calculated(duration: float):
-                    used_meta_candidate["full_response_latency"] = duration
-                    print(f"⏱️ 完整生成耗时: {duration:.2f}s")
-                
-                # 使用全能包装器 _stream_managed 代替原有的逻辑
-                async for chunk in self._stream_managed(
-                    generator=stream,
-                    first_chunk_timeout=first_chunk_timeout,
-                    inter_chunk_timeout=self.stream_inter_chunk_timeout,
-                    total_timeout=self.stream_total_timeout,
-                    on_chunk_received=_track_chunk_and_record_metric,
-                    provider_name=provider_display_name,
-                    on_duration_calculated=_on_duration_calculated
-                ):
-                    yield chunk
+        logger.error(f"💔 所有重试均失败，返回兜底话术")
+        yield "抱歉，回复出现了问题，后台正在加紧修复，请耐心等待"
 
-                print(f"✅ AI生成成功（第{attempt + 1}次尝试，提供方: {provider_display_name}）")
-                
-                # 🆕 结束标志前，再次回调以透传最终时长
-                if on_used_instructions and used_meta_candidate:
-                    try:
-                        on_used_instructions(dict(used_meta_candidate))
-                    except Exception as _e:
-                        print(f"⚠️ on_used_instructions (final) 回调执行失败: {_e}")
-                
-                return
+    def _open_attempt(self, attempt: int, total_attempts: int, profile: CallProfile, caller: object,
+                      on_used_instructions: Optional[Callable[[Mapping[str, Any]], None]],
+                      stream_kwargs: Dict[str, Any]) -> tuple:
+        """
+        发起一次 AI 调用尝试，返回 (受控流式生成器, 本次尝试的指令元数据)
 
-            except Exception as e:
-                # 🔴 T0: 记录 AI 调用失败
-                AI_PROVIDER_CALLS_FAILED_TOTAL.labels(provider=provider_display_name, error_type=type(e).__name__).inc()
-                
-                print(f"❌ AI生成失败（第{attempt + 1}次尝试）: {e}")
-
-                if attempt == total_attempts - 1:
-                    print(f"💔 所有重试均失败，返回兜底话术")
-                    yield "抱歉，回复出现了问题，后台正在加紧修复，请耐心等待"
-                    return
-                else:
-                    print(f"🔄 准备进行第{attempt + 2}次重试...")
-                    continue
+        on_used_instructions 为 None 时首响达成不回调（由调用方决定何时回调）。
+        """
+        # 环境变量配置已在初始化时解析
+        model_env = profile.model
+        provider_display_name = profile.provider_name
+
+        logger.debug(f"🔄 AI生成尝试 #{attempt + 1}/{total_attempts}")
+        logger.info(f"🚀 本次尝试使用提供方: {provider_display_name} | 模型: {model_env} | 模式: {stream_kwargs.get('model_mode')} | 首字超时: {profile.first_chunk_timeout}s")
+
+        # 📊 T0: 记录 AI 调用次数
+        profile.calls_total_metric.inc()
+
+        # ⏱️ T1: 记录 AI 请求发起时间；单次尝试的状态与回调集中在 _AttemptState 中
+        state = _AttemptState(
+            profile=profile,
+            attempt_count=attempt + 1,
+            ai_req_start=time.time(),
+            on_used_instructions=on_used_instructions
+        )
+
+        stream = self.generate_reply_stream(
+            caller=caller,
+            model_name=model_env,
+            on_used_instructions=state.capture_used_instructions,
+            **stream_kwargs
+        )
+
+        # 使用全能包装器 _stream_managed 代替原有的逻辑
+        managed = self._stream_managed(
+            generator=stream,
+            first_chunk_timeout=profile.first_chunk_timeout,
+            inter_chunk_timeout=self.stream_inter_chunk_timeout,
+            total_timeout=self.stream_total_timeout,
+            on_chunk_received=state.track_chunk,
+            provider_name=provider_display_name,
+            on_duration_calculated=state.on_duration
+        )
+        return managed, state.meta
+
+    def _record_attempt_failure(self, attempt: int, profile: CallProfile, error: Exception, total_attempts: int) -> None:
+        """记录一次失败的尝试（监控 + 日志）"""
+        # 🔴 T0: 记录 AI 调用失败
+        profile.failed_metric(type(error).__name__).inc()
+
+        logger.warning(f"❌ AI生成失败（第{attempt + 1}次尝试）: {error}")
+        if attempt < total_attempts - 1:
+            logger.info(f"🔄 准备进行第{attempt + 2}次重试...")
+
+    async def _race_first_chunk(self, contenders: List[tuple], total_attempts: int,
+                                stream_kwargs: Dict[str, Any]) -> Optional[tuple]:
+        """
+        对冲发起两个尝试，返回最先产出首个 chunk 的胜者：
+        (attempt, profile, 受控生成器, 指令元数据, 首个chunk)；全部失败时返回 None
+
+        第一个尝试先行发起，超过 hedge_delay 仍无首响（或已失败）时再发起第二个；
+        胜者确定后取消并关闭落败者。
+        """
+        launched: Dict[asyncio.Task, tuple] = {}
+
+        def _launch(contender: tuple) -> None:
+            index, profile, caller = contender
+            managed, used_meta_candidate = self._open_attempt(
+                index, total_attempts, profile, caller, None, stream_kwargs
+            )
+            task = asyncio.ensure_future(managed.__anext__())
+            launched[task] = (index, profile, managed, used_meta_candidate)
+
+        winner = None
+        pending = set()
+        try:
+            _launch(contenders[0])
+            pending = set(launched)
+            done, pending = await asyncio.wait(pending, timeout=self.stream_hedge_delay)
+            first_failed = bool(done) and next(iter(done)).exception() is not None
+            if not done or first_failed:
+                logger.info(f"🏁 {contenders[0][1].provider_name} 未在 {self.stream_hedge_delay}s 内首响，并行发起 {contenders[1][1].provider_name}")
+                _launch(contenders[1])
+                pending |= set(launched) - done
+
+            while True:
+                # 按策略链顺序处理已完成的尝试，同时完成时优先选靠前的提供方
+                for task in sorted(done, key=lambda t: launched[t][0]):
+                    index, profile, managed, used_meta_candidate = launched[task]
+                    error = task.exception()
+                    if error is not None:
+                        self._record_attempt_failure(index, profile, error, total_attempts)
+                    elif winner is None:
+                        winner = (index, profile, managed, used_meta_candidate, task.result())
+                    else:
+                        # 同时产出首响的落败者，后台关闭
+                        self._spawn_background(self._aclose_quietly(managed))
+                if winner is not None or not pending:
+                    return winner
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # 取消仍在等待首响的落败者（包括本协程自身被取消的情况），其清理放到后台，不阻塞胜者输出
+            for task in pending:
+                task.cancel()
+                self._spawn_background(self._discard_contender(task, launched[task][2]))
+
+    def _spawn_background(self, coro) -> None:
+        """在后台执行清理协程，并持有任务引用直到完成（避免被 GC 回收）"""
+        task = asyncio.ensure_future(coro)
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
+
+    @staticmethod
+    async def _aclose_quietly(generator: AsyncGenerator) -> None:
+        """关闭异步生成器，忽略关闭过程中的异常"""
+        with contextlib.suppress(Exception):
+            await generator.aclose()
+
+    @staticmethod
+    async def _discard_contender(task: asyncio.Task, managed: AsyncGenerator) -> None:
+        """等待已取消的对冲落败者结束并关闭其生成器"""
+        with contextlib.suppress(BaseException):
+            await task
+        with contextlib.suppress(Exception):
+            await managed.aclose()
+
+    async def aclose_background_tasks(self) -> None:
+        """等待所有后台清理任务结束（服务关闭时调用）"""
+        if self._bg_tasks:
+            await asyncio.gather(*self._bg_tasks, return_exceptions=True)
 
     def _safe_for_logging(self, text: str, max_length: int = 50) -> str:
-        """安全地截断文本用于日志输出"""
+        """
+        安全地截断文本用于日志输出
+
+        - 超过 max_length 时截断并追加 "..."
+        - 仅当截断后的文本含有无法编码的字符（如孤立代理项）时才做 backslashreplace 转义，
+          常见文本直接返回切片
+        """
         if not text:
             return ""
-        if len(text) <= max_length:
-            return text
-        return text[:max_length] + "..."
+        truncated = len(text) > max_length
+        if truncated:
+            text = text[:max_length]
+        if not text.isascii():
+            try:
+                text.encode('utf-8')
+            except UnicodeEncodeError:
+                text = text.encode('utf-8', 'backslashreplace').decode('utf-8')
+        return text + "..." if truncated else text
 
     def _select_default_caller(self) -> Optional[object]:
         """
         选择一个默认可用的调用器：
         优先 DeepSeek，其次 Gemini，其次 Novel、Grok；如果都不存在则返回 None
         """
-        if self.deepseek_1:
-            return self.deepseek_1
-        if self.gemini:
-            return self.gemini
-        if self.novel:
-            return self.novel
-        if self.grok:
-            return self.grok
-        return None
+        return next((c for c in self._default_caller_chain if c is not None), None)
     
     # get_last_used_instructions 已废弃（移除）
 
@@ -1,24 +1,85 @@
-import uuid
+import os
+import time
 import asyncio
+import itertools
+import weakref
 import logging
-from typing import Optional, Dict, Any, List
+import operator
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, Iterable, List, Mapping, Set
+
+# 定位用户消息时先在尾部逐条比较的条数，其余部分按 message_id 列批量查找
+_LOCATE_TAIL_SCAN = 8
+_get_message_id = operator.itemgetter("message_id")
+
+# 日志中按角色显示的图标
+_ROLE_EMOJI = {"user": "👤", "assistant": "🤖"}
+
+# 每日限额按东八区自然日计算（与 get_user_daily_message_count 一致）
+_BEIJING_TZ = timezone(timedelta(hours=8))
 
 class MessageService:
+    # 内存回退存储最多保留的会话数，超出后按最近最少使用淘汰，避免无 Redis 部署下内存无限增长
+    MEMORY_FALLBACK_MAX_SESSIONS = int(os.getenv("MEMORY_FALLBACK_MAX_SESSIONS", "1000"))
+    # 内存回退存储中每个会话最多保留的消息条数（环形缓冲，超出后丢弃最早的消息）
+    MEMORY_FALLBACK_MAX_MESSAGES = int(os.getenv("MEMORY_FALLBACK_MAX_MESSAGES", "2000"))
+    # 会话信息缓存容量（LRU 淘汰），避免长时间运行的进程中缓存无限增长
+    SESSION_CACHE_MAX_SIZE = int(os.getenv("SESSION_CACHE_MAX_SIZE", "10000"))
+    # 会话信息缓存有效期（秒），兜底失效通知丢失时的陈旧读取
+    SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "300"))
+    # 用户当日消息数在 Redis 中的缓存时长（秒），过期后从数据库重新校准
+    DAILY_COUNT_CACHE_TTL = int(os.getenv("DAILY_COUNT_CACHE_TTL", "60"))
+    # 每个会话记录最近多少条用户消息的下标（重新生成/截断定位用）
+    USER_POSITION_HINTS = 16
+
     def __init__(self, message_repository=None, session_service=None, redis_store=None):
         # 仅在无 Redis 配置时使用的内存回退存储，不作为缓存使用
-        self._memory_fallback = {}  # { session_id: [ {role, content, message_id} ] }
+        self._memory_fallback: "OrderedDict[str, deque[Dict[str, Any]]]" = OrderedDict()  # { session_id: deque([ {role, content, message_id} ]) }
         self.message_repository = message_repository
         self.session_service = session_service
         self.redis_store = redis_store
         self.logger = logging.getLogger(__name__)
         
         # 用于存储会话相关信息的缓存
-        self._session_cache = {}  # { session_id: { user_id, role_id } }
+        self._session_cache: "OrderedDict[str, tuple]" = OrderedDict()  # { session_id: ({ user_id, role_id }, 过期时刻) }
+        # 会话角色变更时由 SessionService 回调，丢弃本进程缓存（跨进程由 Redis Pub/Sub 通知）
+        if hasattr(session_service, "add_change_listener"):
+            session_service.add_change_listener(self.invalidate_session_cache)
+        
+        # 消息ID生成器：8位十六进制 = 进程级随机前缀(16bit) + 自增计数(16bit)
+        # 计数每回绕一次就重新抽取前缀，避免回绕后与会话中尚存的旧ID重复
+        self._id_prefix = os.urandom(2).hex()
+        self._id_counter = itertools.count(int.from_bytes(os.urandom(2), "big"))
+        
+        # 会话级互斥锁（重新生成/截断的读-改-写），无人持有时随弱引用自动回收
+        self._session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        
+        # 最近用户消息在会话列表中的下标：{ session_id: { message_id: index } }，按会话 LRU 淘汰
+        # 仅作定位提示：左侧截断/其他进程写入都会使下标失效，使用前必须与实际历史比对
+        self._user_positions: "OrderedDict[str, Dict[str, int]]" = OrderedDict()
+        
+        # 进行中的会话信息查询（单飞），见 _get_session_info
+        self._session_inflight: Dict[str, asyncio.Future] = {}
+        
+        # 跨进程会话缓存失效监听任务（见 start_invalidation_listener）
+        self._invalidation_task: Optional[asyncio.Task] = None
+        
+        # 整轮落库后更新当日消息数缓存的任务（持有强引用避免被 GC，aclose 时等待完成）
+        self._count_tasks: Set[asyncio.Task] = set()
+        
+        # 默认每日限制在初始化时读取一次，check_daily_limit 热路径不再重复导入配置
+        self._default_daily_limit: Optional[int] = None
+        try:
+            from src.utils.config.settings import get_settings
+            self._default_daily_limit = get_settings().daily_limit
+        except Exception as e:
+            self.logger.error(f"❌ 无法读取配置中的daily_limit，请检查环境变量DAILY_LIMIT是否设置: {e}")
 
     async def save_message(self, session_id, role, content):
         if len(content) > 10000:
             raise ValueError("4002: 消息过长，最大长度 10000")
-        message_id = uuid.uuid4().hex[:8]  
+        message_id = self._next_message_id()
         
         message_data = {
             "message_id": message_id,
@@ -26,117 +87,113 @@ class MessageService:
             "content": content
         }
         
-        current_count = 0
+        # 写入后的会话消息条数（未知时为 0），用于记录用户消息下标
+        length = 0
         
         # 核心逻辑：直接操作 Redis，移除本地内存缓存同步
         if self.redis_store:
             try:
-                await self.redis_store.append_message(session_id, message_data)
-                # 兜底：确保会话书签与元信息已持久化，避免重启后丢失 session 指针/角色
-                if self.session_service:
-                    await self._ensure_session_persisted(session_id)
-                # 获取当前长度用于日志（可选，为了性能可以去掉）
-                # messages = await self.redis_store.get_messages(session_id)
-                # current_count = len(messages)
+                # 追加消息 + 兜底补齐会话书签与元信息（避免重启后丢失 session 指针/角色），单次 pipeline 往返
+                length = await self._append_and_persist(session_id, message_data)
             except Exception as _e:
                 self.logger.error(f"写穿 Redis 失败: {session_id}, err={_e}")
         else:
             # 无 Redis 配置时的降级处理
-            if session_id not in self._memory_fallback:
-                self._memory_fallback[session_id] = []
-            self._memory_fallback[session_id].append(message_data)
-            current_count = len(self._memory_fallback[session_id])
-        
-        # 打印保存的消息信息
-        print(f"💾 保存消息 | Session: {session_id} | Role: {role} | ID: {message_id}")
-        # print(f"📝 内容: {content}")
-        # print(f"📊 当前会话消息数: {current_count}")
-        print("-" * 50)
-        
-        # 异步写入Supabase（如果配置了message_repository）
-        if self.message_repository and self.session_service:
-            # 只保存机器人消息，用户消息等AI处理完成后带指令一起保存
-            # 这样避免重复保存：一次不带指令，一次带指令
-            if role == "assistant":  # 机器人消息立即保存
-                asyncio.create_task(self._async_save_to_supabase(session_id, role, content, message_id))
-            # 用户消息不在这里保存，等AI处理完成后通过save_user_message_with_real_instructions_async保存
+            messages = self._memory_fallback.get(session_id)
+            if messages is None:
+                messages = self._fallback_put(session_id, ())
+            else:
+                self._memory_fallback.move_to_end(session_id)
+            messages.append(message_data)
+            length = len(messages)
+        
+        if role == "user" and length:
+            self._remember_user_position(session_id, message_id, length - 1)
+        
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("💾 保存消息 | Session: %s | Role: %s | ID: %s | len=%d", session_id, role, message_id, len(content))
+        
+        # Supabase 持久化不在这里触发（单行单轮策略）：
+        # - 用户消息等 AI 处理完成后通过 save_user_message_with_real_instructions_async 带指令整轮写入
+        # - 机器人回复随整轮写入或通过 update_last_user_message_reply 覆盖
         
         return message_id
     
-    async def _ensure_session_persisted(self, session_id: str) -> None:
+    async def aclose(self) -> None:
+        """停止会话缓存失效监听，等待未完成的当日消息数缓存更新"""
+        await self.stop_invalidation_listener()
+        if self._count_tasks:
+            await asyncio.gather(*self._count_tasks, return_exceptions=True)
+
+    def _next_message_id(self) -> str:
+        """生成会话内唯一的 8 位十六进制消息ID（替代 uuid4().hex[:8]，无需每条消息读取 urandom）"""
+        n = next(self._id_counter) & 0xFFFF
+        if n == 0:
+            self._id_prefix = os.urandom(2).hex()
+        return f"{self._id_prefix}{n:04x}"
+    
+    def _fallback_put(self, session_id: str, messages: Iterable[Dict[str, Any]]) -> "deque[Dict[str, Any]]":
+        """
+        写入内存回退存储并标记为最近使用；超出容量时淘汰最久未访问的会话
+        每个会话以定长 deque 保存，追加 O(1) 且内存有上限；返回写入的 deque
+        """
+        buffer = deque(messages, maxlen=self.MEMORY_FALLBACK_MAX_MESSAGES)
+        self._memory_fallback[session_id] = buffer
+        self._memory_fallback.move_to_end(session_id)
+        while len(self._memory_fallback) > self.MEMORY_FALLBACK_MAX_SESSIONS:
+            evicted, _ = self._memory_fallback.popitem(last=False)
+            self.logger.debug("内存回退存储已满，淘汰会话: %s", evicted)
+        return buffer
+    
+    def _session_lock(self, session_id: str) -> asyncio.Lock:
+        lock = self._session_locks.get(session_id)
+        if lock is None:
+            lock = self._session_locks[session_id] = asyncio.Lock()
+        return lock
+
+    def _remember_user_position(self, session_id: str, message_id: str, index: int) -> None:
+        """记录用户消息下标；每个会话只保留最近 USER_POSITION_HINTS 条，会话数超出上限时淘汰最久未用的会话"""
+        positions = self._user_positions.get(session_id)
+        if positions is None:
+            positions = self._user_positions[session_id] = {}
+            if len(self._user_positions) > self.SESSION_CACHE_MAX_SIZE:
+                self._user_positions.popitem(last=False)
+        else:
+            self._user_positions.move_to_end(session_id)
+        positions[message_id] = index
+        if len(positions) > self.USER_POSITION_HINTS:
+            del positions[next(iter(positions))]
+
+    def _user_position_hint(self, session_id: str, message_id: str) -> Optional[int]:
+        positions = self._user_positions.get(session_id)
+        return positions.get(message_id) if positions else None
+
+    async def _append_and_persist(self, session_id: str, message_data: Dict[str, Any]) -> int:
         """
-        确保 Redis 中存在：
-        - sess:current:{user_id} -> session_id
+        追加消息，并确保 Redis 中存在：
+        - sess:current:{user_id} -> session_id（仅不存在时写入）
+        - sess:last:{user_id} -> session_id
         - sess:data:{session_id} -> { user_id, role_id, ... }
         目的：即便最初创建会话时未成功写指针，后续任一消息保存都会补齐。
+        所有写入通过 redis_store.append_message_and_persist 合并为一次往返；
+        会话信息不可用时仅追加消息。
+        返回写入后的会话消息条数（未知时为 0）。
         """
-        try:
-            if not self.redis_store or not self.session_service:
-                return
-            session_info = await self._get_session_info(session_id)
-            if not session_info:
-                return
-            user_id = session_info.get("user_id")
-            role_id = session_info.get("role_id")
-            if not user_id:
-                return
-            # 读取书签，若不存在则写入
+        session_info = None
+        if self.session_service:
             try:
-                current_sid = await self.redis_store.get_current_session_id(str(user_id))
-            except Exception:
-                current_sid = None
-            if not current_sid:
-                await self.redis_store.set_current_session_id(str(user_id), session_id)
-            # 冗余索引：同步写入 last 指针
-            try:
-                await self.redis_store.set_last_session_id(str(user_id), session_id)
-                self.logger.debug(f"_ensure_session_persisted: 已写入 last 指针 user_id={user_id}, session_id={session_id}")
-            except Exception:
-                pass
-            # 回写/覆盖元信息
-            data = {
-                "session_id": session_id,
-                "user_id": str(user_id),
-                "role_id": role_id
-            }
-            await self.redis_store.set_session_data(session_id, data)
-            self.logger.info(f"🧷 已确保会话指针与元信息存在: user_id={user_id}, session_id={session_id}, role_id={role_id}")
-        except Exception as e:
-            self.logger.debug(f"ensure_session_persisted 失败: session_id={session_id}, err={e}")
-    
-    async def _async_save_to_supabase(self, session_id: str, role: str, content: str, message_id: str):
-        """异步保存消息到Supabase"""
-        try:
-            # 获取会话信息（用户ID和角色ID）
-            session_info = await self._get_session_info(session_id)
-            if not session_info:
-                self.logger.warning(f"⚠️ 无法获取会话信息: session_id={session_id}")
-                return
-            
-            user_id = session_info.get("user_id")
-            role_id = session_info.get("role_id")  # 可以为 None
-            
-            if not user_id:
-                self.logger.warning(f"⚠️ 会话缺少用户ID: session_id={session_id}")
-                return
-            
-            # 转换为字符串类型（适配 TEXT 字段）
-            user_id = str(user_id)
-            role_id = str(role_id) if role_id is not None else None
-            
-            # 转换role格式：assistant -> bot
-            sender = "bot" if role == "assistant" else "user"
-            
-            # 新策略（单行单轮）：bot 回复不再单独入库，避免产生 bot-only 行
-            # 最终持久化通过 save_user_message_with_real_instructions_async（写整轮）
-            # 或通过 update_last_user_message_reply（覆盖最新一轮的回复字段）完成
-            if sender == "bot":
-                return
-            
-            self.logger.info(f"✅ 消息已异步保存到Supabase: session_id={session_id}, sender={sender}, user_id={user_id}, role_id={role_id}")
-            
-        except Exception as e:
-            self.logger.error(f"❌ 异步保存消息到Supabase失败: {e}")
+                session_info = await self._get_session_info(session_id)
+            except Exception as e:
+                self.logger.debug(f"获取会话信息失败，仅追加消息: session_id={session_id}, err={e}")
+        user_id = session_info.get("user_id") if session_info else None
+        if not user_id:
+            await self.redis_store.append_message(session_id, message_data)
+            return 0
+        role_id = session_info.get("role_id")
+        length = await self.redis_store.append_message_and_persist(session_id, message_data, user_id, role_id)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"🧷 已确保会话指针与元信息存在: user_id={user_id}, session_id={session_id}, role_id={role_id}")
+        return length or 0
     
     async def get_user_message_count(self, user_id: str) -> int:
         """
@@ -166,7 +223,8 @@ class MessageService:
             # 注意：Redis 历史包含当前刚追加的消息，而本方法语义是"已持久化/之前的"数量
             # 所以这里减 1 以保持语义一致性（在未截断场景下）
             history = await self.get_history(session_id, log=False)
-            count = sum(1 for m in history if isinstance(m, dict) and m.get("role") == "user")
+            # 存储层只返回 dict 形式的消息（LRANGE 解析时已过滤），无需逐条 isinstance
+            count = sum(1 for m in history if m["role"] == "user")
             return max(0, count - 1)
         except Exception as e:
             self.logger.error(f"❌ 获取会话轮次失败: {e}")
@@ -190,12 +248,8 @@ class MessageService:
         """
         # 如果没有传入daily_limit，从配置中读取
         if daily_limit is None:
-            try:
-                from src.utils.config.settings import get_settings
-                settings = get_settings()
-                daily_limit = settings.daily_limit
-            except Exception as e:
-                self.logger.error(f"❌ 无法读取配置中的daily_limit，请检查环境变量DAILY_LIMIT是否设置: {e}")
+            daily_limit = self._default_daily_limit
+            if daily_limit is None:
                 raise ValueError("DAILY_LIMIT环境变量未设置或配置错误")
         
         try:
@@ -208,8 +262,13 @@ class MessageService:
                     "remaining": daily_limit
                 }
             
-            # 获取今日已发送消息数量
-            current_count = await self.message_repository.get_user_daily_message_count(str(user_id))
+            # 获取今日已发送消息数量（优先读 Redis 短期缓存，未命中再查数据库）
+            user_id = str(user_id)
+            day = datetime.now(_BEIJING_TZ).strftime("%Y%m%d")
+            current_count = await self._get_cached_daily_count(user_id, day)
+            if current_count is None:
+                current_count = await self.message_repository.get_user_daily_message_count(user_id)
+                await self._set_cached_daily_count(user_id, day, current_count)
             remaining = max(0, daily_limit - current_count)
             allowed = current_count < daily_limit
             
@@ -233,28 +292,121 @@ class MessageService:
                 "remaining": daily_limit
             }
     
+    async def _get_cached_daily_count(self, user_id: str, day: str) -> Optional[int]:
+        if not self.redis_store:
+            return None
+        try:
+            return await self.redis_store.get_daily_message_count(user_id, day)
+        except Exception as e:
+            self.logger.debug(f"读取当日消息数缓存失败: user_id={user_id}, err={e}")
+            return None
+
+    async def _set_cached_daily_count(self, user_id: str, day: str, count: int) -> None:
+        """缓存未命中时以数据库结果写入带 TTL 的缓存；检查本身不计数，计数只在整轮落库后发生（见 save_user_round_async）"""
+        if not self.redis_store:
+            return
+        try:
+            await self.redis_store.set_daily_message_count(user_id, day, count, self.DAILY_COUNT_CACHE_TTL)
+        except Exception as e:
+            self.logger.debug(f"写入当日消息数缓存失败: user_id={user_id}, err={e}")
+
+    def save_user_round_async(self, user_id: str, **fields: Any) -> asyncio.Future:
+        """
+        异步保存整轮用户消息（透传给 save_user_message_with_real_instructions_async），
+        落库成功后把当日消息数缓存 +1，使缓存与数据库计数（round > 0 的行）保持一致
+        """
+        fut = self.message_repository.save_user_message_with_real_instructions_async(user_id=user_id, **fields)
+        if self.redis_store and (fields.get("round") or 0) > 0:
+            task = asyncio.ensure_future(self._count_saved_round(str(user_id), fut))
+            self._count_tasks.add(task)
+            task.add_done_callback(self._count_tasks.discard)
+        return fut
+
+    async def _count_saved_round(self, user_id: str, saved: asyncio.Future) -> None:
+        try:
+            if await saved is None:
+                return
+            day = datetime.now(_BEIJING_TZ).strftime("%Y%m%d")
+            await self.redis_store.incr_daily_message_count(user_id, day)
+        except Exception as e:
+            self.logger.debug(f"更新当日消息数缓存失败: user_id={user_id}, err={e}")
+
     async def _get_session_info(self, session_id: str) -> Optional[Dict[str, Any]]:
         """获取会话信息（带缓存）"""
-        # 先检查缓存
-        if session_id in self._session_cache:
-            return self._session_cache[session_id]
+        # 先检查缓存（命中即标记为最近使用）
+        cached = self._session_cache.get(session_id)
+        if cached is not None:
+            session_info, expires_at = cached
+            if time.monotonic() < expires_at:
+                self._session_cache.move_to_end(session_id)
+                return session_info
+            del self._session_cache[session_id]
         
-        # 从session_service获取
+        # 单飞：同一会话并发未命中时只发起一次查询，其余协程等待同一结果
+        # shield 保证某个调用方被取消时不会连带取消共享的查询
+        task = self._session_inflight.get(session_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_session_info(session_id))
+            self._session_inflight[session_id] = task
+            task.add_done_callback(lambda _t: self._session_inflight.pop(session_id, None))
+        return await asyncio.shield(task)
+
+    async def _fetch_session_info(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """从 session_service 读取会话信息并写入缓存"""
         try:
             session = await self.session_service.get_session(session_id)
             if session:
+                # 在写入缓存时一次性转为字符串（适配 TEXT 字段），后续每条消息无需重复 str()
+                user_id = session.get("user_id")
+                role_id = session.get("role_id")
                 session_info = {
-                    "user_id": session.get("user_id"),
-                    "role_id": session.get("role_id")  # 保持 None 而不是空字符串
+                    "user_id": str(user_id) if user_id is not None else None,
+                    "role_id": str(role_id) if role_id is not None else None  # 保持 None 而不是空字符串
                 }
-                # 缓存结果
-                self._session_cache[session_id] = session_info
+                # 缓存结果，超出容量时淘汰最久未使用的会话
+                self._session_cache[session_id] = (session_info, time.monotonic() + self.SESSION_CACHE_TTL)
+                if len(self._session_cache) > self.SESSION_CACHE_MAX_SIZE:
+                    self._session_cache.popitem(last=False)
                 return session_info
         except Exception as e:
             self.logger.error(f"❌ 获取会话信息失败: {e}")
         
         return None
 
+    def invalidate_session_cache(self, session_id: str) -> None:
+        """丢弃某会话缓存的 user_id/role_id，下次访问时重新读取"""
+        self._session_cache.pop(session_id, None)
+
+    def start_invalidation_listener(self) -> None:
+        """启动 Redis Pub/Sub 失效监听：其他进程修改会话角色后，本进程的会话信息缓存随之失效"""
+        if self._invalidation_task is not None or not hasattr(self.redis_store, "subscribe_session_invalidations"):
+            return
+        self._invalidation_task = asyncio.create_task(self._invalidation_listener())
+
+    async def stop_invalidation_listener(self) -> None:
+        task, self._invalidation_task = self._invalidation_task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def _invalidation_listener(self) -> None:
+        backoff = 1.0
+        while True:
+            try:
+                async for session_id in self.redis_store.subscribe_session_invalidations():
+                    backoff = 1.0
+                    self.invalidate_session_cache(session_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.warning(f"⚠️ 会话失效订阅中断，{backoff:.0f}s 后重连: {e}")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
     async def get_history(self, session_id: str, force: bool = False, log: bool = True) -> List[Dict[str, Any]]:
         """
         获取会话历史
@@ -276,86 +428,118 @@ class MessageService:
                 self.logger.error(f"从 Redis 获取历史失败: {session_id}, err={_e}")
                 history = []
         else:
-            history = self._memory_fallback.get(session_id, [])
+            buffer = self._memory_fallback.get(session_id)
+            if buffer:
+                self._memory_fallback.move_to_end(session_id)
+                history = list(buffer)
             
-        if log:
-            print(f"📚 获取历史({source}) | Session: {session_id} | 消息数量: {len(history)}")
-            if history:
-                print("📖 历史消息内容:")
-                for i, msg in enumerate(history):
-                    role_emoji = "👤" if msg["role"] == "user" else "🤖"
-                    print(f"  [{i+1}] {role_emoji} {msg['role']} (ID: {msg['message_id']})")
-                    content_preview = msg['content'][:100] + "..." if len(msg['content']) > 100 else msg['content']
-                    print(f"      📝 {content_preview}")
-                print("📚" + "="*48)
-            else:
-                print("📚 历史记录为空")
-                print("📚" + "="*48)
+        # 历史预览仅在 DEBUG 级别构造，INFO 及以上不做任何切片/格式化
+        if log and self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("📚 获取历史(%s) | Session: %s | 消息数量: %d", source, session_id, len(history))
+            for i, msg in enumerate(history):
+                role_emoji = _ROLE_EMOJI.get(msg["role"], "❓")
+                content_preview = msg['content'][:100] + "..." if len(msg['content']) > 100 else msg['content']
+                self.logger.debug("  [%d] %s %s (ID: %s) 📝 %s", i + 1, role_emoji, msg['role'], msg['message_id'], content_preview)
         return history or []
     
     async def ensure_history_loaded(self, session_id: str, force: bool = False) -> int:
         """
-        [适配器方法] 异步确保历史已加载
-        现在直接调用 get_history 即可，因为不再维护本地缓存状态
+        [适配器方法] 异步确保历史已加载，返回消息条数
+        不再维护本地缓存状态，无需真正加载：Redis 下仅取 LLEN，不拉取/解析整个历史；
+        内存回退下直接取环形缓冲的长度，不复制消息列表
         """
-        history = await self.get_history(session_id, force=force)
+        if not session_id:
+            return 0
+        if self.redis_store:
+            try:
+                return await self.redis_store.get_message_count(session_id)
+            except Exception as e:
+                # 旧 KV 存储等 LLEN 不可用时回退为完整读取
+                self.logger.debug(f"LLEN 失败，回退读取完整历史: session_id={session_id}, err={e}")
+        else:
+            buffer = self._memory_fallback.get(session_id)
+            if not buffer:
+                return 0
+            self._memory_fallback.move_to_end(session_id)
+            return len(buffer)
+        history = await self.get_history(session_id, force=force, log=False)
         return len(history)
        
 
+    @staticmethod
+    def _locate_user_message(history: List[Dict[str, Any]], message_id: str, hint: Optional[int] = None) -> Optional[int]:
+        """
+        在历史中定位指定 message_id 的用户消息，返回其下标；找不到返回 None
+        - hint 为保存时记录的下标，校验命中即 O(1) 返回；失效（截断/并发写入导致偏移）时回退扫描
+        - 先比较 message_id（区分度最高），命中后再校验 role，避免每条消息都做两次比较
+        - 先从尾部检查最近几条：重新生成/截断几乎总是针对最近一条用户消息，通常 1~2 次比较即可命中
+        - 仍未命中时，把 message_id 抽成一列后用 list.index 在 C 层查找，避免逐条 Python 比较
+        """
+        if hint is not None and 0 <= hint < len(history):
+            # 只有用户消息会记录下标，ID 吻合即可确认，无需再比较 role
+            if history[hint]["message_id"] == message_id:
+                return hint
+        tail_start = max(0, len(history) - _LOCATE_TAIL_SCAN)
+        for i in range(len(history) - 1, tail_start - 1, -1):
+            msg = history[i]
+            if msg["message_id"] == message_id:
+                return i if msg["role"] == "user" else None
+        try:
+            i = list(map(_get_message_id, history[:tail_start])).index(message_id)
+        except ValueError:
+            return None
+        return i if history[i]["role"] == "user" else None
+
     async def regenerate_reply(self, session_id: str, last_message_id: str, ai_port, role_data, session_context_source=None):
         """
         基于指定用户消息重新生成回复
         - 读 Redis -> 修剪 -> 写回 Redis -> 生成 -> 追加 Redis
         """
-        # 1. 获取历史 (直接从 Redis)
-        history = await self.get_history(session_id)
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.info(f"[DEBUG] regenerate_reply: session_id={session_id}, last_message_id={last_message_id}")
-        # logger.info(f"[DEBUG] regenerate_reply: current history={history}")
-
-        if not history:
-            logger.warning(f"[DEBUG] regenerate_reply: history is empty for session_id={session_id}")
-            return {"message_id": None, "reply": "⚠️ 没有找到历史记录"}
-
-        # 2. 定位到用户消息
-        target_index = next(
-            (i for i, msg in enumerate(history) if msg["message_id"] == last_message_id and msg["role"] == "user"),
-            None
-        )
-        logger.info(f"[DEBUG] regenerate_reply: target_index={target_index}")
-
-        if target_index is None:
-            logger.warning(
-                f"[DEBUG] regenerate_reply: cannot find user message_id={last_message_id} in history "
-                f"(session_id={session_id})"
-            )
-            return {"message_id": None, "reply": "⚠️ 无法找到指定的用户消息"}
-
-        user_input = history[target_index]["content"]
-        logger.info(f"[DEBUG] regenerate_reply: found user_input={user_input}")
-
-        # 3. 删除该用户消息之后的 Bot 回复
-        history = history[:target_index + 1]
-        
-        # 4. 覆盖写回 (Redis优先)
-        if self.redis_store:
-            try:
-                await self.redis_store.set_messages(session_id, history)
-            except Exception as _e:
-                logger.error(f"回写 Redis 失败(regenerate trim): {session_id}, err={_e}")
-        else:
-            self._memory_fallback[session_id] = history
+        # 1~4 读取-定位-截断按会话串行，避免同一会话并发的重新生成/截断交错写入
+        async with self._session_lock(session_id):
+            # 1. 获取历史 (直接从 Redis)
+            history = await self.get_history(session_id)
+            self.logger.debug("regenerate_reply: session_id=%s, last_message_id=%s, history_len=%d", session_id, last_message_id, len(history))
+
+            if not history:
+                self.logger.warning(f"[DEBUG] regenerate_reply: history is empty for session_id={session_id}")
+                return {"message_id": None, "reply": "⚠️ 没有找到历史记录"}
+
+            # 2. 定位到用户消息
+            target_index = self._locate_user_message(history, last_message_id, self._user_position_hint(session_id, last_message_id))
+            self.logger.debug("regenerate_reply: target_index=%s", target_index)
+
+            if target_index is None:
+                self.logger.warning(
+                    f"[DEBUG] regenerate_reply: cannot find user message_id={last_message_id} in history "
+                    f"(session_id={session_id})"
+                )
+                return {"message_id": None, "reply": "⚠️ 无法找到指定的用户消息"}
+
+            user_input = history[target_index]["content"]
+            self.logger.debug("regenerate_reply: found user_input len=%d", len(user_input))
+
+            # 3. 删除该用户消息之后的 Bot 回复
+            history = history[:target_index + 1]
+        
+            # 4. 截断存储 (Redis优先)
+            if self.redis_store:
+                try:
+                    await self._trim_redis_history(session_id, history)
+                except Exception as _e:
+                    self.logger.error(f"回写 Redis 失败(regenerate trim): {session_id}, err={_e}")
+            else:
+                self._fallback_put(session_id, history)
             
-        logger.info(f"[DEBUG] regenerate_reply: trimmed history length={len(history)}")
+            self.logger.debug("regenerate_reply: trimmed history length=%d", len(history))
 
         # 5. 重新生成 AI 回复（使用流式生成并收集完整回复）
-        reply = ""
+        reply_chunks: List[str] = []
         used_instructions_meta: Dict[str, Any] = {}
         def _on_used_instructions(meta: Dict[str, Any]) -> None:
             try:
                 used_instructions_meta.clear()
-                if isinstance(meta, dict):
+                if isinstance(meta, Mapping):
                     used_instructions_meta.update(meta)
             except Exception:
                 pass
@@ -370,19 +554,20 @@ class MessageService:
             on_used_instructions=_on_used_instructions,
             apply_enhancement=False
         ):
-            reply += chunk
-        logger.info(f"[DEBUG] regenerate_reply: new reply={reply}")
+            reply_chunks.append(chunk)
+        reply = "".join(reply_chunks)
+        self.logger.debug("regenerate_reply: new reply len=%d", len(reply))
 
         # 6. 删除旧的 Bot 回复并保存新的 Bot 回复（保持严格 user-bot 交替）
         try:
             if self.message_repository:
                 await self.message_repository.delete_last_bot_message(session_id)
         except Exception as e:
-            logger.debug(f"删除旧机器人消息失败(regenerate): {e}")
+            self.logger.debug(f"删除旧机器人消息失败(regenerate): {e}")
             
         # save_message 会处理 Redis 的追加
         bot_message_id = await self.save_message(session_id, "assistant", reply)
-        logger.info(f"[DEBUG] regenerate_reply: saved new bot_message_id={bot_message_id}")
+        self.logger.debug("regenerate_reply: saved new bot_message_id=%s", bot_message_id)
         
         # 7. 覆盖最新用户消息中的 bot_reply/history/model
         try:
@@ -398,76 +583,106 @@ class MessageService:
                         constructed.extend(role_data.get("history") or [])
                     constructed.extend(history or [])
                     final_messages = constructed
-                import json
-                try:
-                    history_json_str = json.dumps(final_messages, ensure_ascii=False)
-                except Exception:
-                    history_json_str = None
                 await self.message_repository.update_last_user_message_reply(
                     session_id=session_id,
                     bot_reply=reply,
-                    history=history_json_str,
+                    history=final_messages,
                     model_name=model_name
                 )
         except Exception as e:
-            logger.debug(f"覆盖最新用户消息失败(regenerate): {e}")
+            self.logger.debug(f"覆盖最新用户消息失败(regenerate): {e}")
         
-        # 额外打印重新生成的回复信息
-        print(f"🔄 重新生成回复 | Session: {session_id} | 基于用户消息ID: {last_message_id}")
-        print(f"🤖 新Bot回复ID: {bot_message_id}")
-        print("=" * 50)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("🔄 重新生成回复 | Session: %s | 基于用户消息ID: %s | 新Bot回复ID: %s", session_id, last_message_id, bot_message_id)
 
         return {"message_id": bot_message_id, "reply": reply}
 
+    async def _trim_redis_history(self, session_id: str, kept_history: List[Dict[str, Any]]) -> None:
+        """
+        将 Redis 中的会话历史截断为 kept_history（原历史的前缀）
+        - 优先 LTRIM 原地截断：O(1) 网络负载，无需重新序列化保留的消息
+        - 旧 KV 存储等 LTRIM 不可用时回退为整表覆盖写回
+        """
+        try:
+            await self.redis_store.trim_to(session_id, len(kept_history) - 1)
+        except Exception as e:
+            self.logger.debug(f"LTRIM 截断失败，回退为覆盖写回: session_id={session_id}, err={e}")
+            await self.redis_store.set_messages(session_id, kept_history)
+
+    async def _truncate_at_position_hint(self, session_id: str, user_message_id: str) -> Optional[str]:
+        """
+        用保存时记录的下标定位用户消息：LINDEX 校验命中后 LTRIM 截断，返回消息内容
+        下标缺失或已失效（校验不通过）时返回 None，由调用方走完整历史路径
+        """
+        hint = self._user_position_hint(session_id, user_message_id)
+        if hint is None:
+            return None
+        try:
+            msg = await self.redis_store.get_message_at(session_id, hint)
+        except Exception as e:
+            self.logger.debug(f"按下标读取消息失败: session_id={session_id}, index={hint}, err={e}")
+            return None
+        if not msg or msg.get("message_id") != user_message_id:
+            return None
+        try:
+            await self.redis_store.trim_to(session_id, hint)
+        except Exception as _e:
+            self.logger.error(f"回写 Redis 失败(truncate): {session_id}, err={_e}")
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("✂️ 截断历史记录 | Session: %s | 基于用户消息ID: %s | 截断后: %d 条", session_id, user_message_id, hint + 1)
+        return msg.get("content")
+
     async def truncate_history_after_message(self, session_id: str, user_message_id: str) -> Optional[str]:
         """
         截断指定用户消息之后的所有回复，并返回用户消息内容
         """
-        history = await self.get_history(session_id)
-        logger = logging.getLogger(__name__)
-        logger.info(f"[DEBUG] truncate_history_after_message: session_id={session_id}, user_message_id={user_message_id}")
+        # 读取-定位-截断按会话串行（与 regenerate_reply 共用会话锁）
+        async with self._session_lock(session_id):
+            # 快速路径：按记录的下标直接读取并截断，无需拉取/解析整个历史
+            if self.redis_store:
+                user_input = await self._truncate_at_position_hint(session_id, user_message_id)
+                if user_input is not None:
+                    return user_input
+        
+            history = await self.get_history(session_id)
+            self.logger.debug("truncate_history_after_message: session_id=%s, user_message_id=%s", session_id, user_message_id)
 
-        if not history:
-            logger.warning(f"[DEBUG] truncate_history_after_message: history is empty for session_id={session_id}")
-            return None
+            if not history:
+                self.logger.warning(f"[DEBUG] truncate_history_after_message: history is empty for session_id={session_id}")
+                return None
 
-        # 1. 定位到用户消息
-        target_index = next(
-            (i for i, msg in enumerate(history) if msg["message_id"] == user_message_id and msg["role"] == "user"),
-            None
-        )
-        logger.info(f"[DEBUG] truncate_history_after_message: target_index={target_index}")
-
-        if target_index is None:
-            logger.warning(
-                f"[DEBUG] truncate_history_after_message: cannot find user message_id={user_message_id} in history "
-                f"(session_id={session_id})"
-            )
-            return None
+            # 1. 定位到用户消息
+            target_index = self._locate_user_message(history, user_message_id, self._user_position_hint(session_id, user_message_id))
+            self.logger.debug("truncate_history_after_message: target_index=%s", target_index)
+
+            if target_index is None:
+                self.logger.warning(
+                    f"[DEBUG] truncate_history_after_message: cannot find user message_id={user_message_id} in history "
+                    f"(session_id={session_id})"
+                )
+                return None
 
-        user_input = history[target_index]["content"]
-        logger.info(f"[DEBUG] truncate_history_after_message: found user_input={user_input}")
+            user_input = history[target_index]["content"]
+            self.logger.debug("truncate_history_after_message: found user_input len=%d", len(user_input))
 
-        # 2. 删除该用户消息之后的所有回复
-        truncated_history = history[:target_index + 1]
+            # 2. 删除该用户消息之后的所有回复
+            truncated_history = history[:target_index + 1]
         
-        # 3. 覆盖写回 Redis
-        if self.redis_store:
-            try:
-                await self.redis_store.set_messages(session_id, truncated_history)
-            except Exception as _e:
-                logger.error(f"回写 Redis 失败(truncate): {session_id}, err={_e}")
-        else:
-            self._memory_fallback[session_id] = truncated_history
+            # 3. 截断 Redis
+            if self.redis_store:
+                try:
+                    await self._trim_redis_history(session_id, truncated_history)
+                except Exception as _e:
+                    self.logger.error(f"回写 Redis 失败(truncate): {session_id}, err={_e}")
+            else:
+                self._fallback_put(session_id, truncated_history)
             
-        logger.info(f"[DEBUG] truncate_history_after_message: truncated history length={len(truncated_history)}")
+            self.logger.debug("truncate_history_after_message: truncated history length=%d", len(truncated_history))
         
-        # 打印截断信息
-        print(f"✂️ 截断历史记录 | Session: {session_id} | 基于用户消息ID: {user_message_id}")
-        print(f"📊 截断前: {len(history)} 条消息 | 截断后: {len(truncated_history)} 条消息")
-        print("=" * 50)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("✂️ 截断历史记录 | Session: %s | 基于用户消息ID: %s | 截断前: %d 条 | 截断后: %d 条", session_id, user_message_id, len(history), len(truncated_history))
 
-        return user_input
+            return user_input
 
     async def restore_history_to_memory(self, session_id: str, messages: List[Dict[str, str]]) -> int:
         """
@@ -484,20 +699,13 @@ class MessageService:
         if not messages:
             return 0
         
-        # 生成消息ID并构造标准格式
-        restored_messages = []
-        for m in messages:
-            role = m.get("role", "")
-            content = m.get("content", "")
-            
-            if role and content:
-                message_id = uuid.uuid4().hex[:8]
-                message_data = {
-                    "message_id": message_id,
-                    "role": role,
-                    "content": content
-                }
-                restored_messages.append(message_data)
+        # 生成消息ID并构造标准格式（单次推导，直接构造最终 dict，不经过中间变量）
+        next_id = self._next_message_id
+        restored_messages = [
+            {"message_id": next_id(), "role": role, "content": content}
+            for role, content in ((m.get("role"), m.get("content")) for m in messages)
+            if role and content
+        ]
         
         # 写入存储 (优先 Redis)
         if self.redis_store:
@@ -506,17 +714,19 @@ class MessageService:
             except Exception as _e:
                 self.logger.error(f"回写 Redis 失败(restore): {session_id}, err={_e}")
         else:
-            self._memory_fallback[session_id] = restored_messages
+            self._fallback_put(session_id, restored_messages)
+        
+        # 会话被整体替换：旧下标全部作废，按恢复后的顺序重建用户消息下标
+        self._user_positions.pop(session_id, None)
+        for index, msg in enumerate(restored_messages):
+            if msg["role"] == "user":
+                self._remember_user_position(session_id, msg["message_id"], index)
         
         self.logger.info(f"🔄 快照历史已恢复到存储: session_id={session_id}, count={len(restored_messages)}")
-        print(f"🔄 快照历史恢复 | Session: {session_id} | 恢复消息数: {len(restored_messages)}")
-        print("📋 恢复的消息:")
-        for i, msg in enumerate(restored_messages):
-            role_emoji = "👤" if msg["role"] == "user" else "🤖"
-            print(f"  [{i+1}] {role_emoji} {msg['role']} (ID: {msg['message_id']})")
-            content_preview = msg['content'][:100] + "..." if len(msg['content']) > 100 else msg['content']
-            print(f"      📝 {content_preview}")
-        print("🔄" + "="*48)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            user_count = sum(1 for msg in restored_messages if msg["role"] == "user")
+            self.logger.debug("  恢复明细: 用户消息 %d 条, 其他 %d 条, 跳过空消息 %d 条",
+                              user_count, len(restored_messages) - user_count, len(messages) - len(restored_messages))
         
         return len(restored_messages)
 
@@ -2,21 +2,33 @@
 支付服务 - 负责支付订单和积分充值相关的业务逻辑
 """
 
+import os
+import asyncio
 import logging
 import uuid
 import json
 import hashlib
 import time
-import random
-import string
-from typing import Dict, Any, Optional, List, Union
-from datetime import datetime, timedelta
+import itertools
+from collections import Counter, OrderedDict
+from typing import Dict, Any, Optional, List, Tuple, Union
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 from decimal import Decimal
+from dataclasses import dataclass, field
 
+# 套餐/支付方式/赠送比例配置在模块加载时导入一次，避免热路径上每次调用都执行 import；
+# 配置模块不可用时置为 None，由各方法回退到内置默认值
+try:
+    from src.utils.config.app_config import (
+        CREDIT_PACKAGES, PAYMENT_METHODS, FIRST_CHARGE_BONUS, REGULAR_CHARGE_BONUS
+    )
+except ImportError:
+    CREDIT_PACKAGES = PAYMENT_METHODS = FIRST_CHARGE_BONUS = REGULAR_CHARGE_BONUS = None
 
-class OrderStatus(Enum):
-    """订单状态枚举"""
+
+class OrderStatus(str, Enum):
+    """订单状态枚举（str 混入：成员本身即字符串，可直接与数据库中的状态值比较/做集合成员判断）"""
     PENDING = "pending"      # 待支付
     PAID = "paid"           # 已支付
     COMPLETED = "completed"  # 已完成
@@ -25,41 +37,56 @@ class OrderStatus(Enum):
     FAILED = "failed"       # 支付失败
 
 
-class PaymentMethod(Enum):
-    """支付方式枚举"""
+class PaymentMethod(str, Enum):
+    """支付方式枚举（str 混入，同 OrderStatus）"""
     ALIPAY = "alipay"       # 支付宝
     WECHAT = "wechat"       # 微信支付
     QQ = "qqpay"           # QQ钱包
     UNION = "unionpay"      # 银联支付
 
 
+# 状态字符串在模块加载时取出，热路径直接比较普通字符串，避免反复访问 Enum .value
+_STATUS_PENDING = OrderStatus.PENDING.value
+_STATUS_PAID = OrderStatus.PAID.value
+_STATUS_COMPLETED = OrderStatus.COMPLETED.value
+_STATUS_EXPIRED = OrderStatus.EXPIRED.value
+_STATUS_CANCELLED = OrderStatus.CANCELLED.value
+
+# 终态订单状态集合：模块加载时计算一次，查询时直接做哈希成员判断
+_FINAL_ORDER_STATUSES = frozenset((_STATUS_PAID, _STATUS_COMPLETED, _STATUS_EXPIRED, _STATUS_CANCELLED))
+# 视为"已购买"的订单状态（首充判断）
+_PURCHASED_STATUSES = frozenset((_STATUS_PAID, _STATUS_COMPLETED))
+
+
+@dataclass(frozen=True, slots=True)
 class PaymentPackage:
-    """支付套餐类"""
+    """支付套餐类（不可变：加载后只读，可在实例间/请求间安全共享，并可作为缓存键）"""
     
-    def __init__(self, 
-                 package_id: str,
-                 name: str,
-                 credits: int,
-                 price: Decimal,
-                 description: str = "",
-                 is_active: bool = True):
-        self.package_id = package_id
-        self.name = name
-        self.credits = credits
-        self.price = price
-        self.description = description
-        self.is_active = is_active
+    package_id: str
+    name: str
+    credits: int
+    price: Decimal
+    description: str = ""
+    is_active: bool = True
+    # 以下为派生字段：实例不可变，创建时算好一次（不参与比较/哈希）
+    price_float: float = field(init=False, repr=False, compare=False)
+    _dict: Dict[str, Any] = field(init=False, repr=False, compare=False)
     
-    def to_dict(self) -> Dict[str, Any]:
-        """转换为字典"""
-        return {
+    def __post_init__(self):
+        price_float = float(self.price)
+        object.__setattr__(self, "price_float", price_float)
+        object.__setattr__(self, "_dict", {
             "package_id": self.package_id,
             "name": self.name,
             "credits": self.credits,
-            "price": float(self.price),
+            "price": price_float,
             "description": self.description,
             "is_active": self.is_active
-        }
+        })
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为字典（返回预先构建好的字典的副本，调用方可自由修改）"""
+        return dict(self._dict)
     
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'PaymentPackage':
@@ -74,9 +101,23 @@ class PaymentPackage:
         )
 
 
+# 配置缺失时的默认套餐：模块加载时构建一次，各 PaymentService 实例共享同一组不可变对象
+_DEFAULT_PACKAGES: Dict[str, PaymentPackage] = {
+    "basic": PaymentPackage("basic", "基础套餐", 100, Decimal("10.00")),
+    "premium": PaymentPackage("premium", "高级套餐", 500, Decimal("45.00")),
+    "ultimate": PaymentPackage("ultimate", "终极套餐", 1000, Decimal("80.00"))
+}
+
+
 class PaymentService:
     """支付处理服务（已迁移：仅依赖 PointCompositeRepository）"""
     
+    # 过期订单批量清理的间隔（秒）：查询订单时不再逐单写入过期状态，统一由定时任务一次性落库
+    EXPIRED_ORDER_CLEANUP_INTERVAL = float(os.getenv("EXPIRED_ORDER_CLEANUP_INTERVAL", "60"))
+    # 用户首充状态缓存时长（秒）与容量（LRU 淘汰）：套餐菜单每次渲染都要判断首充，避免反复查库
+    FIRST_PURCHASE_CACHE_TTL = float(os.getenv("FIRST_PURCHASE_CACHE_TTL", "30"))
+    FIRST_PURCHASE_CACHE_MAX_SIZE = int(os.getenv("FIRST_PURCHASE_CACHE_MAX_SIZE", "10000"))
+    
     # 修改：去除对单表仓库与UserService的依赖，统一走组合仓库
     def __init__(self, 
                  payment_config: Dict[str, Any] = None,
@@ -91,6 +132,33 @@ class PaymentService:
         self.logger.info("🔧 PaymentService: 使用PointCompositeRepository")
         # 加载套餐配置
         self._load_packages()
+        # 可用套餐/支付方式只依赖配置，初始化时算好，菜单渲染时直接返回
+        self._available_packages: Tuple[PaymentPackage, ...] = tuple(
+            pkg for pkg_id, pkg in self.packages.items() if pkg_id != "test" and pkg.is_active
+        )
+        methods = PAYMENT_METHODS if PAYMENT_METHODS is not None else {"alipay": "支付宝", "wechat": "微信支付"}
+        self._available_methods: Tuple[Dict[str, str], ...] = tuple(
+            {"id": method_id, "name": method_name} for method_id, method_name in methods.items()
+        )
+        self._valid_method_ids = frozenset(methods)
+        # 过期订单定时清理任务（由应用启动时调用 start_expired_order_cleanup 开启）
+        self._cleanup_task: Optional[asyncio.Task] = None
+        # user_id -> (过期时间, 是否首充)；积分发放成功后立即失效
+        self._first_purchase_cache: "OrderedDict[Any, Tuple[float, bool]]" = OrderedDict()
+        # (package_id, 是否首充) -> (赠送积分, 文案)：只依赖配置，键数有界，无需过期
+        self._bonus_render_cache: Dict[Tuple[str, bool], Tuple[int, str]] = {}
+        # 订单号序列：随机起点（多进程间错开），递增取低 6 位拼在秒级时间戳后
+        self._order_seq = itertools.count(int.from_bytes(os.urandom(3), "big"))
+        # 赠送比例表：缺少配置时所有套餐按默认比例（首充50%/常规10%）赠送，
+        # 配置存在但未列出的套餐不赠送
+        if FIRST_CHARGE_BONUS is None:
+            self._first_bonus, self._first_bonus_default = {}, 50
+        else:
+            self._first_bonus, self._first_bonus_default = FIRST_CHARGE_BONUS, 0
+        if REGULAR_CHARGE_BONUS is None:
+            self._regular_bonus, self._regular_bonus_default = {}, 10
+        else:
+            self._regular_bonus, self._regular_bonus_default = REGULAR_CHARGE_BONUS, 0
     
     # （并行验证相关代码已移除）
     
@@ -98,9 +166,14 @@ class PaymentService:
         """加载套餐配置"""
         self.packages = {}
         
+        if CREDIT_PACKAGES is None:
+            self.logger.warning("导入套餐配置失败: src.utils.config.app_config 不可用")
+            # 默认套餐配置
+            self.packages = dict(_DEFAULT_PACKAGES)
+            return
+        
         # 从配置加载套餐
         try:
-            from src.utils.config.app_config import CREDIT_PACKAGES
             for package_id, config in CREDIT_PACKAGES.items():
                 package = PaymentPackage.from_dict({
                     "package_id": package_id,
@@ -108,54 +181,26 @@ class PaymentService:
                 })
                 self.packages[package_id] = package
             self.logger.info(f"成功加载 {len(self.packages)} 个套餐")
-        except ImportError as e:
-            self.logger.warning(f"导入套餐配置失败: {e}")
-            # 默认套餐配置
-            self.packages = {
-                "basic": PaymentPackage("basic", "基础套餐", 100, Decimal("10.00")),
-                "premium": PaymentPackage("premium", "高级套餐", 500, Decimal("45.00")),
-                "ultimate": PaymentPackage("ultimate", "终极套餐", 1000, Decimal("80.00"))
-            }
         except Exception as e:
             self.logger.error(f"加载套餐配置异常: {e}")
             # 默认套餐配置
-            self.packages = {
-                "basic": PaymentPackage("basic", "基础套餐", 100, Decimal("10.00")),
-                "premium": PaymentPackage("premium", "高级套餐", 500, Decimal("45.00")),
-                "ultimate": PaymentPackage("ultimate", "终极套餐", 1000, Decimal("80.00"))
-            }
+            self.packages = dict(_DEFAULT_PACKAGES)
     
-    def get_available_packages(self) -> List[PaymentPackage]:
-        """获取可用的支付套餐"""
-        packages = []
-        for pkg_id, pkg in self.packages.items():
-            if pkg_id != "test" and pkg.is_active:
-                packages.append(pkg)
-        return packages
+    def get_available_packages(self) -> Tuple[PaymentPackage, ...]:
+        """获取可用的支付套餐（初始化时预先筛选）"""
+        return self._available_packages
     
     def get_package(self, package_id: str) -> Optional[PaymentPackage]:
         """获取指定套餐"""
         return self.packages.get(package_id)
     
-    def get_available_payment_methods(self) -> List[Dict[str, str]]:
-        """获取可用的支付方式"""
-        try:
-            from src.utils.config.app_config import PAYMENT_METHODS
-            return [
-                {"id": method_id, "name": method_name}
-                for method_id, method_name in PAYMENT_METHODS.items()
-            ]
-        except ImportError:
-            return [
-                {"id": "alipay", "name": "支付宝"},
-                {"id": "wechat", "name": "微信支付"}
-            ]
+    def get_available_payment_methods(self) -> Tuple[Dict[str, str], ...]:
+        """获取可用的支付方式（初始化时预先构建）"""
+        return self._available_methods
     
     def _generate_order_id(self) -> str:
-        """生成订单号"""
-        timestamp = str(int(time.time()))
-        random_str = ''.join(random.choices(string.digits, k=6))
-        return f"{timestamp}{random_str}"
+        """生成订单号：秒级时间戳 + 6 位序号（格式与原先一致，同一秒内 100 万单以内不重复）"""
+        return f"{int(time.time())}{next(self._order_seq) % 1000000:06d}"
     
     async def create_payment_order(self, 
                                  user_id: int,
@@ -172,8 +217,7 @@ class PaymentService:
                 }
             
             # 验证支付方式
-            valid_methods = [method["id"] for method in self.get_available_payment_methods()]
-            if payment_method not in valid_methods:
+            if payment_method not in self._valid_method_ids:
                 return {
                     "success": False,
                     "error": f"无效的支付方式: {payment_method}"
@@ -183,27 +227,21 @@ class PaymentService:
             order_id = self._generate_order_id()
             expires_at = datetime.utcnow() + timedelta(minutes=30)
             
-            order_data = {
-                'user_id': user_id,
-                'order_id': order_id,
-                'amount': float(package.price),
-                'status': OrderStatus.PENDING.value,
-                'payment_method': payment_method,
-                'points_awarded': package.credits,
-                'order_data': {
-                    'package_id': package_id,
-                    'package_name': package.name,
-                    'expires_at': expires_at.isoformat()
-                }
-            }
+            # 仓库只需要订单扩展信息，其余字段已通过参数传入，不再构造外层订单字典
+            expires_at_iso = expires_at.isoformat()
+            amount = package.price_float
             
             # 修改：通过组合仓库创建待支付订单
             created_order = await self.point_composite_repo.create_pending_order(
                 user_id=user_id,
                 order_id=order_id,
-                amount=float(package.price),
+                amount=amount,
                 payment_method=payment_method,
-                order_data=order_data['order_data']
+                order_data={
+                    'package_id': package_id,
+                    'package_name': package.name,
+                    'expires_at': expires_at_iso
+                }
             )
             if not created_order:
                 return {
@@ -242,9 +280,9 @@ class PaymentService:
                 "success": True,
                 "order_id": order_id,
                 "package": package.to_dict(),
-                "amount": float(package.price),
+                "amount": amount,
                 "credits": package.credits,
-                "expires_at": expires_at.isoformat(),
+                "expires_at": expires_at_iso,
                 "payment_info": payment_info
             }
             
@@ -267,8 +305,7 @@ class PaymentService:
                 }
             
             # 如果订单已经是最终状态，直接返回
-            if order['status'] in [OrderStatus.PAID.value, OrderStatus.COMPLETED.value, 
-                                 OrderStatus.EXPIRED.value, OrderStatus.CANCELLED.value]:
+            if order['status'] in _FINAL_ORDER_STATUSES:
                 return {
                     "success": True,
                     "order": order,
@@ -276,19 +313,15 @@ class PaymentService:
                 }
             
             # 检查订单是否过期
-            order_data = order.get('order_data', {})
-            expires_at_str = order_data.get('expires_at')
-            if expires_at_str:
-                expires_at = datetime.fromisoformat(expires_at_str.replace('Z', '+00:00'))
-                if datetime.utcnow() > expires_at.replace(tzinfo=None):
-                    # 更新为过期状态
-                    await self.point_composite_repo.update_order_status(order_id, OrderStatus.EXPIRED.value)
-                    return {
-                        "success": True,
-                        "order": order,
-                        "status": OrderStatus.EXPIRED.value,
-                        "message": "订单已过期"
-                    }
+            if self._is_order_expired(order):
+                # 仅在响应中标记为过期，不逐单写库；过期状态由 cleanup_expired_orders 定时批量落库，
+                # 库中仍为 pending 的过期订单由 process_payment_callback 自行拒绝
+                return {
+                    "success": True,
+                    "order": order,
+                    "status": _STATUS_EXPIRED,
+                    "message": "订单已过期"
+                }
             
             # 如果有支付API，查询第三方支付状态
             if self.payment_api:
@@ -301,10 +334,11 @@ class PaymentService:
                         
                         if platform_status == 1:  # 支付成功
                             # 先检查首充状态
-                            is_first_purchase = await self.is_first_purchase(order['user_id'])
+                            is_first_purchase = await self.is_first_purchase(order['user_id'], use_cache=False)
                             
                             # 更新订单状态为已支付
-                            await self.point_composite_repo.update_order_status(order_id, OrderStatus.PAID.value)
+                            await self.point_composite_repo.update_order_status(order_id, _STATUS_PAID)
+                            self.invalidate_first_purchase_cache(order['user_id'])
                             
                             # 处理支付成功 - 发放积分
                             await self._process_payment_success(order, is_first_purchase)
@@ -312,7 +346,7 @@ class PaymentService:
                             return {
                                 "success": True,
                                 "order": order,
-                                "status": OrderStatus.PAID.value,
+                                "status": _STATUS_PAID,
                                 "message": "支付成功"
                             }
                             
@@ -332,6 +366,21 @@ class PaymentService:
                 "error": f"查询失败: {str(e)}"
             }
     
+    @staticmethod
+    def _is_order_expired(order: Dict[str, Any]) -> bool:
+        """判断订单是否已超过 expires_at
+
+        仓库返回原生 expires_at 列时直接比较，否则解析 order_data 中的 ISO 字符串
+        （Python 3.11 起 fromisoformat 直接支持 'Z' 后缀，无需先替换；无时区的值按 UTC 处理）
+        """
+        expires_at = order.get('expires_at') or order.get('order_data', {}).get('expires_at')
+        if not expires_at:
+            return False
+        if isinstance(expires_at, str):
+            expires_at = datetime.fromisoformat(expires_at)
+        now = datetime.now(timezone.utc) if expires_at.tzinfo else datetime.utcnow()
+        return now > expires_at
+    
     async def process_payment_callback(self, 
                                      order_id: str,
                                      trade_no: str,
@@ -347,12 +396,19 @@ class PaymentService:
                 }
             
             # 检查订单状态
-            if order['status'] != OrderStatus.PENDING.value:
+            if order['status'] != _STATUS_PENDING:
                 return {
                     "success": False,
                     "error": f"订单状态异常: {order['status']}"
                 }
             
+            # 定时清理尚未落库的过期订单同样拒绝
+            if self._is_order_expired(order):
+                return {
+                    "success": False,
+                    "error": "订单已过期"
+                }
+            
             # 验证签名（简化处理）
             if not self._verify_payment_signature(verify_data):
                 return {
@@ -361,10 +417,11 @@ class PaymentService:
                 }
             
             # 检查首充状态
-            is_first_purchase = await self.is_first_purchase(order['user_id'])
+            is_first_purchase = await self.is_first_purchase(order['user_id'], use_cache=False)
             
             # 更新订单状态
-            success = await self.point_composite_repo.update_order_status(order_id, OrderStatus.PAID.value)
+            success = await self.point_composite_repo.update_order_status(order_id, _STATUS_PAID)
+            self.invalidate_first_purchase_cache(order['user_id'])
             
             if not success:
                 return {
@@ -378,7 +435,7 @@ class PaymentService:
             
             if process_result:
                 # 订单完成 - 更新状态为COMPLETED
-                status_updated = await self.point_composite_repo.update_order_status(order_id, OrderStatus.COMPLETED.value)
+                status_updated = await self.point_composite_repo.update_order_status(order_id, _STATUS_COMPLETED)
                 
                 if status_updated:
                     self.logger.info(f"支付订单处理完成: {order_id}")
@@ -454,13 +511,16 @@ class PaymentService:
     async def _process_with_composite_repo(self, order: Dict[str, Any], total_credits: int, description: str) -> bool:
         """🔧 迁移：使用PointCompositeRepository处理支付成功"""
         try:
-            from decimal import Decimal
+            # 仓库已返回 Decimal 时直接透传，否则经 str 转换避免浮点误差
+            amount = order['amount']
+            if not isinstance(amount, Decimal):
+                amount = Decimal(str(amount))
             
             # 调用PointCompositeRepository的process_payment_success方法
             success = await self.point_composite_repo.process_payment_success(
                 user_id=order['user_id'],
                 order_id=order['order_id'],
-                amount=Decimal(str(order['amount'])),
+                amount=amount,
                 points_awarded=total_credits,
                 payment_method=order.get('payment_method'),
                 order_data=order.get('order_data', {})
@@ -486,36 +546,19 @@ class PaymentService:
     
     def calculate_first_purchase_bonus(self, package_id: str, credits: int) -> int:
         """计算首次充值奖励"""
-        try:
-            from src.utils.config.app_config import FIRST_CHARGE_BONUS
-            bonus_rate = FIRST_CHARGE_BONUS.get(package_id, 0)
-        except ImportError:
-            bonus_rate = 50  # 默认50%首充奖励
+        bonus_rate = self._first_bonus.get(package_id, self._first_bonus_default)
         return int(credits * bonus_rate / 100)
     
     def calculate_regular_bonus(self, package_id: str, credits: int) -> int:
         """计算常规充值奖励"""
-        try:
-            from src.utils.config.app_config import REGULAR_CHARGE_BONUS
-            bonus_rate = REGULAR_CHARGE_BONUS.get(package_id, 0)
-        except ImportError:
-            bonus_rate = 10  # 默认10%常规奖励
+        bonus_rate = self._regular_bonus.get(package_id, self._regular_bonus_default)
         return int(credits * bonus_rate / 100)
     
     def _get_bonus_rate(self, package_id: str, is_first_purchase: bool) -> int:
         """获取奖励比例"""
         if is_first_purchase:
-            try:
-                from src.utils.config.app_config import FIRST_CHARGE_BONUS
-                return FIRST_CHARGE_BONUS.get(package_id, 50)
-            except ImportError:
-                return 50
-        else:
-            try:
-                from src.utils.config.app_config import REGULAR_CHARGE_BONUS
-                return REGULAR_CHARGE_BONUS.get(package_id, 10)
-            except ImportError:
-                return 10
+            return self._first_bonus.get(package_id, 50)
+        return self._regular_bonus.get(package_id, 10)
     
     async def get_order_info(self, order_id: str) -> Optional[Dict[str, Any]]:
         """获取订单信息"""
@@ -536,26 +579,20 @@ class PaymentService:
     async def get_payment_statistics(self, user_id: int) -> Dict[str, Any]:
         """获取用户支付统计"""
         try:
-            orders = await self.payment_order_repo.get_user_orders(user_id, 100)
+            orders = await self.point_composite_repo.get_user_orders(user_id, 100)
+            
+            # 计数交给 Counter，金额/积分只对已完成订单求和，避免逐单 if/elif 分支
+            status_counts = Counter(order['status'] for order in orders)
+            completed = [order for order in orders if order['status'] == _STATUS_COMPLETED]
             
-            stats = {
+            return {
                 "total_orders": len(orders),
-                "total_amount": 0.0,
-                "total_credits": 0,
-                "completed_orders": 0,
-                "pending_orders": 0
+                "total_amount": sum((float(order.get('amount', 0)) for order in completed), 0.0),
+                "total_credits": sum(order.get('points_awarded', 0) for order in completed),
+                "completed_orders": status_counts.get(_STATUS_COMPLETED, 0),
+                "pending_orders": status_counts.get(_STATUS_PENDING, 0)
             }
             
-            for order in orders:
-                if order['status'] == OrderStatus.COMPLETED.value:
-                    stats["completed_orders"] += 1
-                    stats["total_amount"] += float(order.get('amount', 0))
-                    stats["total_credits"] += order.get('points_awarded', 0)
-                elif order['status'] == OrderStatus.PENDING.value:
-                    stats["pending_orders"] += 1
-            
-            return stats
-            
         except Exception as e:
             self.logger.error(f"获取支付统计失败: {e}")
             return {
@@ -582,7 +619,7 @@ class PaymentService:
                     "error": "无权操作此订单"
                 }
             
-            if order['status'] != OrderStatus.PENDING.value:
+            if order['status'] != _STATUS_PENDING:
                 return {
                     "success": False,
                     "error": f"订单状态不允许取消: {order['status']}"
@@ -616,23 +653,58 @@ class PaymentService:
             self.logger.error(f"清理过期订单失败: {e}")
             return 0
     
-    async def is_first_purchase(self, user_id: int) -> bool:
-        """检查用户是否首次充值"""
+    def start_expired_order_cleanup(self) -> None:
+        """启动过期订单定时清理：每隔 EXPIRED_ORDER_CLEANUP_INTERVAL 秒批量把超时的待支付订单置为过期"""
+        if self._cleanup_task is not None:
+            return
+        self._cleanup_task = asyncio.create_task(self._expired_order_cleanup_loop())
+    
+    async def stop_expired_order_cleanup(self) -> None:
+        task, self._cleanup_task = self._cleanup_task, None
+        if task is None:
+            return
+        task.cancel()
         try:
-            # 获取用户的支付历史
-            orders = await self.payment_order_repo.get_user_orders(user_id, 5)
-            
-            # 检查是否有已完成的订单
-            for order in orders:
-                if order['status'] in [OrderStatus.PAID.value, OrderStatus.COMPLETED.value]:
-                    return False
+            await task
+        except asyncio.CancelledError:
+            pass
+    
+    async def _expired_order_cleanup_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.EXPIRED_ORDER_CLEANUP_INTERVAL)
+            expired = await self.cleanup_expired_orders()
+            if expired:
+                self.logger.info(f"🧹 已将 {expired} 个超时订单置为过期")
+    
+    async def is_first_purchase(self, user_id: int, use_cache: bool = True) -> bool:
+        """检查用户是否首次充值（结果缓存 FIRST_PURCHASE_CACHE_TTL 秒）
+
+        发放积分前的判断需传 use_cache=False，直接读库，避免用过期的缓存重复发放首充奖励。
+        """
+        cached = self._first_purchase_cache.get(user_id) if use_cache else None
+        now = time.monotonic()
+        if cached is not None and cached[0] > now:
+            self._first_purchase_cache.move_to_end(user_id)
+            return cached[1]
+        try:
+            # 获取用户的支付历史，检查是否有已完成的订单
+            orders = await self.point_composite_repo.get_user_orders(user_id, 5)
+            is_first = not any(order['status'] in _PURCHASED_STATUSES for order in orders)
             
-            return True
+            self._first_purchase_cache[user_id] = (now + self.FIRST_PURCHASE_CACHE_TTL, is_first)
+            self._first_purchase_cache.move_to_end(user_id)
+            if len(self._first_purchase_cache) > self.FIRST_PURCHASE_CACHE_MAX_SIZE:
+                self._first_purchase_cache.popitem(last=False)
+            return is_first
             
         except Exception as e:
             self.logger.error(f"检查首次充值状态失败: {e}")
             return False
     
+    def invalidate_first_purchase_cache(self, user_id: int) -> None:
+        """订单置为已支付后清除该用户的首充缓存"""
+        self._first_purchase_cache.pop(user_id, None)
+    
     async def get_user_total_spent(self, user_id: int) -> float:
         """获取用户总消费金额"""
         try:
@@ -651,6 +723,20 @@ class PaymentService:
             self.logger.error(f"获取用户总购买积分失败: {e}")
             return 0
     
+    def _render_bonus(self, package: PaymentPackage, is_first: bool) -> Tuple[int, str]:
+        """计算套餐的赠送积分与展示文案，按 (package_id, 是否首充) 缓存"""
+        key = (package.package_id, is_first)
+        rendered = self._bonus_render_cache.get(key)
+        if rendered is None:
+            if is_first:
+                bonus_credits = self.calculate_first_purchase_bonus(package.package_id, package.credits)
+                rendered = (bonus_credits, f"首冲送{bonus_credits}积分！")
+            else:
+                bonus_credits = self.calculate_regular_bonus(package.package_id, package.credits)
+                rendered = (bonus_credits, f"额外赠送{bonus_credits}积分")
+            self._bonus_render_cache[key] = rendered
+        return rendered
+    
     async def get_package_with_bonus(self, package_id: str, user_id: int) -> Optional[Dict[str, Any]]:
         """获取包含奖励信息的套餐信息"""
         try:
@@ -659,21 +745,13 @@ class PaymentService:
                 return None
             
             is_first = await self.is_first_purchase(user_id)
-            
-            if is_first:
-                bonus_credits = self.calculate_first_purchase_bonus(package_id, package.credits)
-                total_credits = package.credits + bonus_credits
-                bonus_text = f"首冲送{bonus_credits}积分！"
-            else:
-                bonus_credits = self.calculate_regular_bonus(package_id, package.credits)
-                total_credits = package.credits + bonus_credits
-                bonus_text = f"额外赠送{bonus_credits}积分"
+            bonus_credits, bonus_text = self._render_bonus(package, is_first)
             
             return {
                 "package": package.to_dict(),
                 "base_credits": package.credits,
                 "bonus_credits": bonus_credits,
-                "total_credits": total_credits,
+                "total_credits": package.credits + bonus_credits,
                 "bonus_text": bonus_text,
                 "is_first_purchase": is_first
             }
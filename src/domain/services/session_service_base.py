@@ -4,9 +4,11 @@
 - 保持接口方法名和类名一致，未来可直接替换为成熟版（基于 SessionCompositeRepository）。
 """
 
-import uuid
+import secrets
+import asyncio
 import logging
-from typing import Dict, Any, Optional
+from datetime import datetime
+from typing import Callable, Dict, Any, List, Optional
 
 
 class SessionService:
@@ -24,12 +26,31 @@ class SessionService:
         # 内存存储：user_id -> session_dict
         self._sessions: Dict[str, Dict[str, Any]] = {}
         self.redis_store = redis_store
+        # 会话元信息变更回调（如 MessageService 丢弃本地缓存），参数为 session_id
+        self._change_listeners: List[Callable[[str], None]] = []
         mode = "Redis+内存回退" if self.redis_store else "仅内存"
         self.logger.info(f"🟢 SessionService 初始化完成 - 模式: {mode}")
 
+    def add_change_listener(self, listener: Callable[[str], None]) -> None:
+        """注册会话元信息（user_id/role_id）变更回调"""
+        self._change_listeners.append(listener)
+
+    async def _notify_session_changed(self, session_id: str) -> None:
+        """通知本进程回调，并广播给其他进程丢弃该会话的本地缓存（尽力而为，失败不影响本次更新）"""
+        for listener in self._change_listeners:
+            try:
+                listener(session_id)
+            except Exception as e:
+                self.logger.debug(f"会话变更回调失败: session_id={session_id}, err={e}")
+        if self.redis_store:
+            try:
+                await self.redis_store.publish_session_invalidation(session_id)
+            except Exception as e:
+                self.logger.debug(f"广播会话失效失败: session_id={session_id}, err={e}")
+
     def generate_session_id(self) -> str:
         """生成唯一的会话ID"""
-        return f"sess_{uuid.uuid4().hex[:8]}"
+        return f"sess_{secrets.token_hex(4)}"
 
     async def create_session(self, user_id: str, role_id: str = None) -> Dict[str, Any]:
         """创建新会话并持久化书签/元信息（若启用 Redis）"""
@@ -44,21 +65,24 @@ class SessionService:
         self._sessions[user_id] = session
         # Redis 写入
         if self.redis_store:
-            try:
-                await self.redis_store.set_current_session_id(str(user_id), session_id)
-                # 同步写入 last 指针，作为冗余索引
-                try:
-                    await self.redis_store.set_last_session_id(str(user_id), session_id)
-                except Exception as _e:
-                    self.logger.debug(f"写入 last 会话指针失败: user_id={user_id}, err={_e}")
-                await self.redis_store.set_session_data(session_id, {
+            # 书签 / last 指针（冗余索引）/ 元信息三次写入互不依赖，并发发出，只等待一次往返
+            uid = str(user_id)
+            current_res, last_res, data_res = await asyncio.gather(
+                self.redis_store.set_current_session_id(uid, session_id),
+                self.redis_store.set_last_session_id(uid, session_id),
+                self.redis_store.set_session_data(session_id, {
                     "session_id": session_id,
-                    "user_id": str(user_id),
+                    "user_id": uid,
                     "role_id": role_id,
-                    "created_at": uuid.uuid4().hex  # 简单占位，可替换为时间戳
-                })
-            except Exception as e:
-                self.logger.debug(f"持久化会话失败: user_id={user_id}, err={e}")
+                    "created_at": datetime.utcnow().isoformat()
+                }),
+                return_exceptions=True
+            )
+            if isinstance(last_res, Exception):
+                self.logger.debug(f"写入 last 会话指针失败: user_id={user_id}, err={last_res}")
+            for res in (current_res, data_res):
+                if isinstance(res, Exception):
+                    self.logger.debug(f"持久化会话失败: user_id={user_id}, err={res}")
         self.logger.info(f"✅ 新建会话: user_id={user_id}, session_id={session_id}, role_id={role_id}")
         return session
 
@@ -227,6 +251,7 @@ class SessionService:
                     await self.redis_store.set_session_data(session_id, data)
                 except Exception as e:
                     self.logger.debug(f"Redis 更新角色失败: session_id={session_id}, err={e}")
+            await self._notify_session_changed(session_id)
             self.logger.info(f"✅ 更新会话角色: session_id={session_id}, role_id={role_id}")
             return True
         self.logger.warning(f"⚠️ 会话不存在，无法设置角色: session_id={session_id}")
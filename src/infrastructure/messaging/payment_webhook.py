@@ -11,7 +11,21 @@ import time
 from datetime import datetime
 
 from src.infrastructure.external_apis.payment_api import PaymentAPI
-from src.utils.config.app_config import PAYMENT_PID, CREDIT_PACKAGES, FIRST_CHARGE_BONUS, REGULAR_CHARGE_BONUS
+from src.utils.config.app_config import PAYMENT_PID, FIRST_CHARGE_BONUS, REGULAR_CHARGE_BONUS
+
+# 异步通知校验用的常量集合：模块加载时构建一次
+_REQUIRED_NOTIFY_PARAMS = ('trade_no', 'out_trade_no', 'type', 'money', 'trade_status')
+_REQUIRED_NOTIFY_KEYS = frozenset(_REQUIRED_NOTIFY_PARAMS)
+_ALLOWED_PIDS = frozenset(('1002', '1008'))
+_KNOWN_PAYMENT_TYPES = frozenset(('alipay', 'wxpay'))
+
+# 跳转页面展示：trade_status -> (页面标题, 图标, 状态文案, 颜色, 提示信息)
+_RETURN_PAGE_STATES = {
+    'TRADE_SUCCESS': ("支付成功", "✅", "支付成功", "#4CAF50", "您的支付已完成，积分正在发放中..."),
+    'TRADE_FINISHED': ("支付完成", "✅", "支付完成", "#4CAF50", "您的支付已完成，积分正在发放中..."),
+    'TRADE_CLOSED': ("支付关闭", "❌", "支付已关闭", "#f44336", "支付已关闭，如有疑问请联系客服"),
+}
+_RETURN_PAGE_PENDING = ("支付处理中", "🔄", "处理中", "#FF9800", "支付正在处理中，请稍候...")
 
 
 class PaymentWebhookHandler:
@@ -78,18 +92,18 @@ class PaymentWebhookHandler:
             self.logger.info(f"收到支付通知: {params}")
             
             # 验证必要参数（按照用户字段列表）
-            required_params = ['trade_no', 'out_trade_no', 'type', 'money', 'trade_status']
-            for param in required_params:
-                if param not in params:
-                    self.logger.error(f"缺少必要参数: {param}")
-                    return "fail"
+            # 成功路径只做一次集合包含判断；缺参时才逐个定位缺失字段用于日志
+            if not _REQUIRED_NOTIFY_KEYS.issubset(params):
+                missing = next(p for p in _REQUIRED_NOTIFY_PARAMS if p not in params)
+                self.logger.error(f"缺少必要参数: {missing}")
+                return "fail"
             
             # 验证字段格式
             try:
                 # 验证商户ID（支持多个PID，兼容1002和1008）
                 if 'pid' in params:
                     pid = params['pid']
-                    if pid not in ['1002', '1008']:
+                    if pid not in _ALLOWED_PIDS:
                         self.logger.error(f"商户ID不匹配: {pid}")
                         return "fail"
                 
@@ -101,7 +115,7 @@ class PaymentWebhookHandler:
                 
                 # 验证支付方式
                 payment_type = params['type']
-                if payment_type not in ['alipay', 'wxpay']:
+                if payment_type not in _KNOWN_PAYMENT_TYPES:
                     self.logger.warning(f"未知支付类型: {payment_type}")
                 
             except ValueError as e:
@@ -158,31 +172,10 @@ class PaymentWebhookHandler:
             order_no = params.get('out_trade_no', 'unknown')
             trade_status = params.get('trade_status', 'unknown')
             
-            # 根据支付状态显示不同页面
-            if trade_status == 'TRADE_SUCCESS':
-                page_title = "支付成功"
-                status_icon = "✅"
-                status_text = "支付成功"
-                status_color = "#4CAF50"
-                message = "您的支付已完成，积分正在发放中..."
-            elif trade_status == 'TRADE_FINISHED':
-                page_title = "支付完成"
-                status_icon = "✅"
-                status_text = "支付完成"
-                status_color = "#4CAF50"
-                message = "您的支付已完成，积分正在发放中..."
-            elif trade_status == 'TRADE_CLOSED':
-                page_title = "支付关闭"
-                status_icon = "❌"
-                status_text = "支付已关闭"
-                status_color = "#f44336"
-                message = "支付已关闭，如有疑问请联系客服"
-            else:
-                page_title = "支付处理中"
-                status_icon = "🔄"
-                status_text = "处理中"
-                status_color = "#FF9800"
-                message = "支付正在处理中，请稍候..."
+            # 根据支付状态显示不同页面（查表一次，替代逐个字符串比较的分支链）
+            page_title, status_icon, status_text, status_color, message = _RETURN_PAGE_STATES.get(
+                trade_status, _RETURN_PAGE_PENDING
+            )
             
             # 显示支付结果页面
             return f"""
@@ -404,41 +397,33 @@ class PaymentWebhookHandler:
                 return
             
             # 检查首充状态（在更新订单前）
-            is_first_purchase = await self.payment_service.is_first_purchase(order['user_id'])
+            is_first_purchase = await self.payment_service.is_first_purchase(order['user_id'], use_cache=False)
             
             # 更新订单状态（不包含trade_no字段，因为表中没有这个字段）
             try:
+                now_iso = datetime.utcnow().isoformat()
                 await self.payment_service.point_composite_repo.update_order_status(
                     order_no, 'paid', {
-                        'paid_at': datetime.utcnow().isoformat(),
-                        'updated_at': datetime.utcnow().isoformat()
+                        'paid_at': now_iso,
+                        'updated_at': now_iso
                     }
                 )
+                self.payment_service.invalidate_first_purchase_cache(order['user_id'])
                 self.logger.info(f"订单状态更新成功: {order_no}")
             except Exception as e:
                 self.logger.error(f"更新订单状态失败: {order_no}, {e}")
                 # 即使订单状态更新失败，也要尝试发放积分
             
-            # 计算积分发放
+            # 计算积分发放（仅用于通知文案；流水描述由 PaymentService 生成）
             order_data = order.get('order_data', {})
             package_id = order_data.get('package_id', 'test')
-            package_info = CREDIT_PACKAGES.get(package_id, {})
             base_credits = order.get('points_awarded', 0)
-            bonus_credits = 0
-            
-            if is_first_purchase:
-                bonus_rate = FIRST_CHARGE_BONUS.get(package_id, 0)
-                bonus_type = "首充赠送"
-            else:
-                bonus_rate = REGULAR_CHARGE_BONUS.get(package_id, 0)
-                bonus_type = "活动赠送"
-            
+            bonus_rate = (FIRST_CHARGE_BONUS if is_first_purchase else REGULAR_CHARGE_BONUS).get(package_id, 0)
             bonus_credits = int(base_credits * bonus_rate / 100)
             total_credits = base_credits + bonus_credits
             credits_awarded = total_credits
             
             # 发放积分
-            description = f"购买{package_info.get('name', '套餐')} + {bonus_type}{bonus_rate}%"
             success = await self.payment_service._process_payment_success(order, is_first_purchase)
             
             if success:
@@ -1,12 +1,25 @@
-import json
+import asyncio
 import time
 import os
-from typing import Any, List, Optional, Dict
+from typing import Any, AsyncIterator, List, Optional, Dict
 import httpx
+import orjson
 from urllib.parse import quote
 import logging
 
 
+# 可以确定请求尚未发出的错误：只有这类错误才能安全地重试非幂等的 RPUSH
+_REQUEST_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# 仅当键存在时 INCR：判断与自增在服务端原子完成，键不存在（未校准或已过期）时不新建
+_INCR_IF_EXISTS_SCRIPT = "if redis.call('EXISTS', KEYS[1]) == 1 then return redis.call('INCR', KEYS[1]) end return nil"
+
+
+def _dumps(obj: Any) -> str:
+    """orjson 序列化为 str（UTF-8 原样输出，等价于 json.dumps(..., ensure_ascii=False)）"""
+    return orjson.dumps(obj).decode()
+
+
 class UpstashSessionStore:
     """
     Upstash Redis REST 适配器（基于 RedisJSON）
@@ -24,6 +37,9 @@ class UpstashSessionStore:
         }
         self._ns = namespace
         self._client = httpx.AsyncClient(timeout=timeout)
+        # 消息追加的批量写入队列与后台循环（首次写入时惰性创建）
+        self._append_queue: Optional[asyncio.Queue] = None
+        self._append_flusher: Optional[asyncio.Task] = None
         logging.getLogger(__name__).info(f"UpstashSessionStore 初始化: base_url={self._base_url}, namespace={self._ns}")
 
     def _key_messages(self, session_id: str) -> str:
@@ -41,11 +57,20 @@ class UpstashSessionStore:
     def _key_last_session(self, user_id: str) -> str:
         return f"{self._ns}:last:{user_id}"
     
+    def _key_daily_count(self, user_id: str, day: str) -> str:
+        return f"{self._ns}:daily_cnt:{user_id}:{day}"
+    
+    def _channel_session_invalidate(self) -> str:
+        return f"{self._ns}:invalidate"
+    
     # 限制每个会话的最多存储 消息条数 (High Water Mark) - 达到此数量触发清理
     MAX_HISTORY_ITEMS = int(os.getenv("MAX_HISTORY_ITEMS", "150"))
     # 清理后保留的消息数量 (Low Water Mark) - 默认为 MAX_HISTORY_ITEMS (即每次都截断，保持原行为)
     # 如果 .env 中未配置 HISTORY_RETENTION_COUNT，则默认行为与 MAX_HISTORY_ITEMS 一致
     HISTORY_RETENTION_COUNT = int(os.getenv("HISTORY_RETENTION_COUNT", str(MAX_HISTORY_ITEMS)))
+    # 消息追加批量写入：单次 pipeline 最多合并的消息条数；收到首条后额外等待的毫秒数（0 = 不等待，仅合并已积压的请求）
+    BULK_SIZE = int(os.getenv("REDIS_BULK_SIZE", "50"))
+    BULK_FLUSH_MS = int(os.getenv("REDIS_BULK_FLUSH_MS", "0"))
 
     async def _cmd(self, *args: str) -> Any:
         """
@@ -102,6 +127,22 @@ class UpstashSessionStore:
             raise RuntimeError(str(data.get("error")))
         return data
 
+    async def _pipeline(self, commands: List[List[Any]], transaction: bool = False) -> List[Dict[str, Any]]:
+        """
+        一次 HTTP 请求批量发送多条命令
+        - 默认 POST {base}/pipeline（非事务）；transaction=True 时 POST {base}/multi-exec（MULTI/EXEC 原子执行）
+        - 返回与 commands 一一对应的结果列表，每项为 {"result": ...} 或 {"error": ...}
+        """
+        payload = [[str(a) for a in cmd] for cmd in commands]
+        endpoint = "multi-exec" if transaction else "pipeline"
+        resp = await self._client.post(f"{self._base_url}/{endpoint}", headers=self._headers, json=payload)
+        if resp.status_code != 200:
+            resp.raise_for_status()
+        data = resp.json()
+        if isinstance(data, dict) and data.get("error"):
+            raise RuntimeError(str(data.get("error")))
+        return data
+
     def _decode_get_result(self, result: Any) -> Any:
         """
         统一解码 Upstash GET 返回，提取 result/value，并在为字符串时尽力解析 JSON。
@@ -120,9 +161,9 @@ class UpstashSessionStore:
             return raw
         if isinstance(raw, str):
             try:
-                parsed = json.loads(raw)
+                parsed = orjson.loads(raw)
                 return parsed
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 return raw
         return raw
 
@@ -145,10 +186,10 @@ class UpstashSessionStore:
             for item in raw_list:
                 if isinstance(item, str):
                     try:
-                        obj = json.loads(item)
+                        obj = orjson.loads(item)
                         if isinstance(obj, dict):
                             messages.append(obj)
-                    except json.JSONDecodeError:
+                    except orjson.JSONDecodeError:
                         # 跳过无法解析的元素
                         pass
                 elif isinstance(item, dict):
@@ -174,45 +215,56 @@ class UpstashSessionStore:
                 return []
             if isinstance(raw, str):
                 try:
-                    parsed = json.loads(raw)
+                    parsed = orjson.loads(raw)
                     if isinstance(parsed, list):
                         return parsed
-                except json.JSONDecodeError:
+                except orjson.JSONDecodeError:
                     return []
             return []
 
 
     async def set_messages(self, session_id: str, messages: List[Dict[str, Any]]) -> None:
         """
-        覆盖写入整个会话消息数组（原子：先 DEL 后 RPUSH 批量追加）
+        覆盖写入整个会话消息数组：DEL + RPUSH 在一次 MULTI/EXEC 请求中原子完成
+        - 读取方不会看到中途被清空的列表；消息放在请求体中，不受 URL 长度限制
+        - 超过高水位线 (MAX_HISTORY_ITEMS) 时只写入最近 HISTORY_RETENTION_COUNT 条（等价于写入后再 LTRIM）
         """
         key = self._key_messages(session_id)
-        # 清空旧值（兼容从 KV/JSON 迁移到 list）
-        try:
-            await self._cmd("del", key)
-        except Exception:
-            # 忽略不存在等错误
-            pass
-        if not messages:
-            print(f"ℹ️ INFO: 会话 {session_id} 消息已更新，共 0 条")
-            return
-        # 批量 RPUSH
-        # Upstash 支持：/rpush/{key}/{value1}/{value2}/...
-        values = [json.dumps(m, ensure_ascii=False) for m in messages]
-        await self._cmd("rpush", key, *values)
-        
-        # 强制截断：防止全量重写导致列表过长
-        # 仅当超过高水位线 (MAX_HISTORY_ITEMS) 时，截断到保留数量 (HISTORY_RETENTION_COUNT)
         if len(messages) > self.MAX_HISTORY_ITEMS:
-            try:
-                await self._cmd("ltrim", key, -self.HISTORY_RETENTION_COUNT, -1)
-            except Exception as e:
-                logging.getLogger(__name__).warning(f"set_messages ltrim 失败: {e}")
+            messages = messages[-self.HISTORY_RETENTION_COUNT:]
+        # DEL 同时兼容从 KV/JSON 迁移到 list
+        commands: List[List[Any]] = [["DEL", key]]
+        if messages:
+            commands.append(["RPUSH", key, *[_dumps(m) for m in messages]])
+        results = await self._pipeline(commands, transaction=True)
+        for cmd_result in results:
+            if isinstance(cmd_result, dict) and cmd_result.get("error"):
+                raise RuntimeError(str(cmd_result.get("error")))
+        logging.getLogger(__name__).debug("会话 %s 消息已更新，共 %d 条", session_id, len(messages))
 
-        # 等待一段时间，确保数据同步到 Redis
-        # time.sleep(1)  # 等待 3 秒，确保数据完全写入
-        # print(f"🔍 Debug: 写入完成，等待 1 秒后继续")
-        print(f"ℹ️ INFO: 会话 {session_id} 消息已更新，共 {len(messages)} 条")
+    async def get_message_count(self, session_id: str) -> int:
+        """会话消息条数（LLEN），无需拉取/解析消息内容"""
+        result = await self._cmd("llen", self._key_messages(session_id))
+        return int(result.get("result") or 0) if isinstance(result, dict) else 0
+
+    async def get_message_at(self, session_id: str, index: int) -> Optional[Dict[str, Any]]:
+        """读取会话中指定下标的单条消息（LINDEX），不存在或无法解析时返回 None"""
+        result = await self._cmd("lindex", self._key_messages(session_id), index)
+        raw = result.get("result") if isinstance(result, dict) else None
+        if not isinstance(raw, str):
+            return None
+        try:
+            message = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            return None
+        return message if isinstance(message, dict) else None
+
+    async def trim_to(self, session_id: str, end_index_inclusive: int) -> None:
+        """
+        原地截断会话消息，仅保留 [0, end_index_inclusive]（LTRIM，无需重写整个列表）
+        - 旧 KV/JSON 存储会因类型冲突抛出异常，由调用方回退到 set_messages
+        """
+        await self._cmd("ltrim", self._key_messages(session_id), 0, end_index_inclusive)
 
     async def append_message(self, session_id: str, message: Dict[str, Any]) -> None:
         """
@@ -222,7 +274,7 @@ class UpstashSessionStore:
         key = self._key_messages(session_id)
         try:
             # 原子追加，避免“读-改-写”并发覆盖
-            resp = await self._cmd("rpush", key, json.dumps(message, ensure_ascii=False))
+            resp = await self._cmd("rpush", key, _dumps(message))
             
             # 获取最新长度 (Upstash RPUSH 返回当前长度)
             current_len = 0
@@ -241,17 +293,162 @@ class UpstashSessionStore:
                 existing = []
             existing.append(message)
             await self.set_messages(session_id, existing)
-    
-        # 确认写入后的消息
-        # print(f"🔍 Debug: 当前历史记录 {current_messages}")
+            current_len = len(existing)
+        # 长度取自 RPUSH 返回值（或迁移后的条数），无需再发 LLEN
+        logging.getLogger(__name__).debug("会话 %s 追加消息成功，当前共 %d 条", session_id, int(current_len))
+
+    async def append_message_and_persist(
+        self,
+        session_id: str,
+        message: Dict[str, Any],
+        user_id: str,
+        role_id: Optional[str],
+    ) -> int:
+        """
+        追加消息并补齐会话书签/元信息：
+        - RPUSH 消息
+        - SET current 指针（NX：仅不存在时写入）
+        - SET last 指针
+        - SET 会话元信息
+        指针与元信息沿用 _cmd("SET") 的存储格式（{"value": ...}），读取端无需改动
+        并发的追加请求进入写入队列，由后台循环合并为一次 pipeline 往返；本协程在本条写入完成后返回，
+        因此调用方随后读取历史仍能看到该消息
+        返回写入（及高水位截断）后的列表长度；长度未知（回退到旧存储迁移）时返回 0
+        """
+        loop = asyncio.get_running_loop()
+        if self._append_queue is None:
+            self._append_queue = asyncio.Queue()
+        if self._append_flusher is None or self._append_flusher.done():
+            self._append_flusher = loop.create_task(self._append_flush_loop())
+        fut = loop.create_future()
+        self._append_queue.put_nowait((session_id, message, user_id, role_id, fut))
+        return await fut
+
+    def _append_commands(self, session_id: str, message: Dict[str, Any], user_id: str, role_id: Optional[str]) -> List[List[Any]]:
+        data = {"session_id": session_id, "user_id": user_id, "role_id": role_id}
+        return [
+            ["RPUSH", self._key_messages(session_id), _dumps(message)],
+            ["SET", self._key_current_session(user_id), _dumps({"value": session_id}), "NX"],
+            ["SET", self._key_last_session(user_id), _dumps({"value": session_id})],
+            ["SET", self._key_session_data(session_id), _dumps({"value": data})],
+        ]
+
+    async def _append_flush_loop(self) -> None:
+        """后台写入循环：取出队列中已积压的追加请求（至多 BULK_SIZE 条），合并为一次 pipeline"""
+        queue = self._append_queue
+        while True:
+            batch = [await queue.get()]
+            if self.BULK_FLUSH_MS > 0:
+                await asyncio.sleep(self.BULK_FLUSH_MS / 1000)
+            while len(batch) < self.BULK_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+            try:
+                await self._write_append_batch(batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _write_append_batch(self, batch: List[Any]) -> None:
+        """
+        整批 pipeline 写入
+        RPUSH 不是幂等的：只有请求确定没有发出（连接失败）时才逐条重试；
+        超时等无法确认服务端是否已执行的错误直接让本批调用方失败，避免重复追加历史
+        """
+        commands: List[List[Any]] = []
+        for session_id, message, user_id, role_id, _fut in batch:
+            commands.extend(self._append_commands(session_id, message, user_id, role_id))
         try:
-            result = await self._cmd("llen", key)
-            length = 0
-            if isinstance(result, dict):
-                length = result.get("result") or result.get("value") or 0
-            print(f"ℹ️ INFO: 会话 {session_id} 追加消息成功，当前共 {int(length)} 条")
-        except Exception:
-            print(f"ℹ️ INFO: 会话 {session_id} 追加消息成功")
+            results = await self._pipeline(commands)
+        except _REQUEST_NOT_SENT_ERRORS as e:
+            logging.getLogger(__name__).warning(f"⚠️ 批量追加消息未能发出，改为逐条写入: {e}")
+            for session_id, message, user_id, role_id, fut in batch:
+                try:
+                    results = await self._pipeline(self._append_commands(session_id, message, user_id, role_id))
+                    current_len = await self._apply_append_results(session_id, message, results)
+                    if current_len > self.MAX_HISTORY_ITEMS:
+                        await self._cmd("ltrim", self._key_messages(session_id), -self.HISTORY_RETENTION_COUNT, -1)
+                except Exception as item_err:
+                    if not fut.done():
+                        fut.set_exception(item_err)
+                    continue
+                if not fut.done():
+                    fut.set_result(self._length_after_trim(current_len, current_len))
+            return
+        except Exception as e:
+            logging.getLogger(__name__).error(f"❌ 批量追加消息失败（无法确认是否已写入，不重试）: {e}")
+            for *_item, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        
+        # 先收集每条的 RPUSH 长度，再按会话取本批最终长度：同一会话多条跨过高水位时只截断一次，
+        # 各条截断后的长度都按最终截断量换算
+        pushed: List[Any] = []
+        final_lens: Dict[str, int] = {}
+        for index, (session_id, message, _user_id, _role_id, fut) in enumerate(batch):
+            try:
+                current_len = await self._apply_append_results(session_id, message, results[index * 4:index * 4 + 4])
+            except Exception as item_err:
+                if not fut.done():
+                    fut.set_exception(item_err)
+                continue
+            pushed.append((session_id, current_len, fut))
+            if current_len > final_lens.get(session_id, 0):
+                final_lens[session_id] = current_len
+        
+        for session_id, current_len, fut in pushed:
+            if not fut.done():
+                fut.set_result(self._length_after_trim(current_len, final_lens.get(session_id, 0)))
+        trims = [
+            ["LTRIM", self._key_messages(session_id), -self.HISTORY_RETENTION_COUNT, -1]
+            for session_id, final_len in final_lens.items()
+            if final_len > self.MAX_HISTORY_ITEMS
+        ]
+        if trims:
+            try:
+                await self._pipeline(trims)
+            except Exception as e:
+                logging.getLogger(__name__).warning(f"批量追加后 ltrim 失败: {e}")
+
+    def _length_after_trim(self, current_len: int, final_len: int) -> int:
+        """
+        current_len 为该条 RPUSH 后的长度，final_len 为同会话本批最后一次 RPUSH 后的长度；
+        final_len 超过高水位时随后的 LTRIM 只保留 HISTORY_RETENTION_COUNT 条，该条之前的元素相应被截掉
+        长度未知（0，回退迁移）或该条本身已被截掉时返回 0
+        """
+        if current_len <= 0 or final_len <= self.MAX_HISTORY_ITEMS:
+            return current_len
+        return max(0, current_len - (final_len - self.HISTORY_RETENTION_COUNT))
+
+    async def _apply_append_results(self, session_id: str, message: Dict[str, Any], results: List[Any]) -> int:
+        """
+        处理单条追加的 pipeline 结果，返回 RPUSH 后的列表长度
+        RPUSH 失败（如旧 KV 存储类型冲突）时回退到 append_message 的迁移逻辑（其内部自行截断），返回 0
+        """
+        logger = logging.getLogger(__name__)
+        for cmd_result in results[1:]:
+            if isinstance(cmd_result, dict) and cmd_result.get("error"):
+                logger.debug(f"append_message_and_persist 书签写入失败: session_id={session_id}, err={cmd_result.get('error')}")
+        
+        push_result = results[0] if results else None
+        if not isinstance(push_result, dict) or push_result.get("error"):
+            await self.append_message(session_id, message)
+            return 0
+        current_len = int(push_result.get("result") or 0)
+        logger.debug(f"会话 {session_id} 追加消息成功，当前共 {current_len} 条")
+        return current_len
+
+    async def aclose(self) -> None:
+        """关闭前写完队列中尚未提交的追加请求，并停止后台写入循环"""
+        if self._append_queue is not None and self._append_flusher is not None and not self._append_flusher.done():
+            await self._append_queue.join()
+        if self._append_flusher is not None:
+            self._append_flusher.cancel()
+            try:
+                await self._append_flusher
+            except asyncio.CancelledError:
+                pass
+            self._append_flusher = None
 
     # ----------------------------
     # Session pointer & metadata
@@ -325,6 +522,56 @@ class UpstashSessionStore:
         except Exception:
             pass
 
+    # ----------------------------
+    # Session metadata invalidation (Pub/Sub)
+    # ----------------------------
+    async def publish_session_invalidation(self, session_id: str) -> None:
+        """广播会话元信息已变更，各进程据此丢弃本地缓存的 user_id/role_id"""
+        await self._cmd("publish", self._channel_session_invalidate(), session_id)
+
+    async def subscribe_session_invalidations(self) -> AsyncIterator[str]:
+        """
+        订阅会话失效广播（Upstash REST 以 SSE 推送），逐条产出被失效的 session_id
+        - 连接断开时迭代结束/抛出异常，由调用方负责重连
+        - SSE 行格式: "data: message,{channel},{payload}"（另有 subscribe 确认行，忽略）
+        """
+        channel = quote(self._channel_session_invalidate(), safe="")
+        url = f"{self._base_url}/subscribe/{channel}"
+        headers = {**self._headers, "Accept": "text/event-stream"}
+        async with self._client.stream("POST", url, headers=headers, timeout=None) as resp:
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                kind, _, rest = line[5:].strip().partition(",")
+                if kind != "message":
+                    continue
+                _channel, _, payload = rest.partition(",")
+                if payload:
+                    yield payload
+
+    # ----------------------------
+    # Daily message count cache
+    # ----------------------------
+    async def get_daily_message_count(self, user_id: str, day: str) -> Optional[int]:
+        """读取缓存的用户当日消息数；未命中（或已过期）返回 None"""
+        result = await self._cmd("GET", self._key_daily_count(user_id, day))
+        value = self._decode_get_result(result)
+        if value is None:
+            return None
+        return int(value)
+
+    async def set_daily_message_count(self, user_id: str, day: str, count: int, ttl_seconds: int) -> None:
+        """以数据库结果校准当日消息数缓存（SETEX，过期后重新从数据库读取）"""
+        await self._cmd("setex", self._key_daily_count(user_id, day), ttl_seconds, count)
+
+    async def incr_daily_message_count(self, user_id: str, day: str) -> None:
+        """
+        缓存存在时将当日消息数 +1（INCR 保留原有 TTL）
+        缓存不存在时不做任何写入，留待下次从数据库校准（避免新建无 TTL 的键）
+        """
+        await self._cmd("eval", _INCR_IF_EXISTS_SCRIPT, 1, self._key_daily_count(user_id, day))
+
     async def get_user_model_mode(self, user_id: str) -> str:
         """获取用户模型模式偏好，默认为 'immersive'"""
         key = self._key_user_model_mode(user_id)
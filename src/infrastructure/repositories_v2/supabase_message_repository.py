@@ -7,18 +7,33 @@ import logging
 import uuid
 import asyncio
 import builtins
-from typing import Optional, Dict, Any, List
+import orjson
+from async_timeout import timeout as _aio_timeout
+from typing import Optional, Dict, Any, List, Union
 from datetime import datetime, timezone
 from .supabase_manager import SupabaseManager
 
+# PostgREST 返回错误响应时抛出的异常：出现它说明请求已被服务端拒绝（整批回滚），可以安全地逐行重试
+try:
+    from postgrest.exceptions import APIError as _PostgrestAPIError
+except ImportError:
+    _PostgrestAPIError = None
+
 
 class SupabaseMessageRepository:
     """Supabase消息仓储"""
     
+    # 异步保存的批量参数：单批最多行数 / 首行入队后最长等待秒数
+    BATCH_MAX_ROWS = 32
+    BATCH_MAX_WAIT = 0.05
+    
     def __init__(self, supabase_manager: SupabaseManager):
         self.supabase_manager = supabase_manager
         self.logger = logging.getLogger(__name__)
         self.table_name = "messages"
+        # 异步写入队列与后台批量写入任务（首次异步保存时惰性创建）
+        self._row_queue: Optional[asyncio.Queue] = None
+        self._flusher: Optional[asyncio.Task] = None
     
     async def save_message(self, user_id: str, role_id: Optional[str], session_id: str, 
                           sender: str,
@@ -54,88 +69,21 @@ class SupabaseMessageRepository:
             消息记录的ID，失败返回None
         """
         try:
-            client = self.supabase_manager.get_client()
-            
-            # 数据验证和转换
-            if not user_id or not user_id.strip():
-                self.logger.error("❌ user_id 不能为空")
+            message_data = self._build_message_row(
+                user_id=user_id, role_id=role_id, session_id=session_id,
+                instructions=instructions, bot_reply=bot_reply, history=history,
+                model_name=model_name, user_input=user_input, round=round,
+                full_response_latency=full_response_latency,
+                first_response_latency=first_response_latency,
+                attempt_count=attempt_count
+            )
+            if message_data is None:
                 return None
-            # sender 参数仅用于兼容旧接口，入库时不再写入，也不做强校验
-            
-            # 轻量数据验证（兼容当前先写bot后补user的流程）
-            if round is not None:
-                try:
-                    if int(round) <= 0:
-                        self.logger.error(f"❌ round 必须为正整数，当前值: {round}")
-                        return None
-                except Exception:
-                    self.logger.error(f"❌ round 必须为整数，当前值: {round}")
-                    return None
-            if user_input is None and bot_reply is None:
-                # 允许短暂不完整（例如先写bot_reply），但记录警告
-                self.logger.warning("⚠️ 本次写入未包含 user_input 或 bot_reply，可能为临时不完整行（将于后续补全）")
-            if user_input is not None and instructions is None:
-                # 用户输入通常伴随指令与历史，缺省并非致命，提醒优化
-                self.logger.debug("ℹ️ 用户输入未携带 instructions（允许，但建议补充以便复现）")
-            if bot_reply is not None and user_input is None and round is None:
-                # 允许 bot 先写，但建议尽快补充 round 以实现一轮一行管理
-                self.logger.debug("ℹ️ 检测到仅 bot_reply 写入且 round 缺失（允许短暂存在，建议后续补充 round 与 user_input）")
-            
-            # 构造消息数据
-            message_data = {
-                "user_id": str(user_id).strip(),
-                "role_id": str(role_id).strip() if role_id else None, 
-                "session_id": str(session_id).strip() if session_id else None
-                # timestamp 由数据库触发器自动设置为东八区时间
-            }
-            # 🆕 新字段写入逻辑：按需添加新字段
-            if instructions is not None:
-                message_data["instructions"] = instructions
-            if bot_reply is not None:
-                message_data["bot_reply"] = bot_reply
-            if history is not None:
-                message_data["history"] = history
-            if model_name is not None:
-                message_data["model_name"] = model_name
-            if user_input is not None:
-                message_data["user_input"] = user_input
-            if round is not None:
-                message_data["round"] = round
-            if full_response_latency is not None:
-                # 数据库字段为 Integer 类型，需将秒数四舍五入为整数
-                try:
-                    # 确保是浮点数或数字
-                    if isinstance(full_response_latency, (int, float)):
-                        message_data["full_response"] = int(builtins.round(float(full_response_latency)))
-                    else:
-                         self.logger.warning(f"⚠️ full_response_latency 类型错误: {type(full_response_latency)}")
-                         message_data["full_response"] = None
-                except Exception as e:
-                    self.logger.warning(f"⚠️ full_response_latency 转换整数失败: {full_response_latency}, error: {e}")
-                    message_data["full_response"] = None
-            
-            # 🆕 新增字段：首响耗时（保留小数，存为 float）
-            if first_response_latency is not None:
-                try:
-                    message_data["first_response_latency"] = float(first_response_latency)
-                except Exception:
-                    self.logger.warning(f"⚠️ first_response_latency 转换失败: {first_response_latency}")
-
-            # 🆕 新增字段：尝试次数（整数）
-            if attempt_count is not None:
-                try:
-                    message_data["attempt_count"] = int(attempt_count)
-                except Exception:
-                    self.logger.warning(f"⚠️ attempt_count 转换失败: {attempt_count}")
             
-            # 异步插入数据（使用线程池避免阻塞主线程）
-            def _sync_insert():
-                return client.table(self.table_name).insert(message_data).execute()
+            rows = await self._insert_rows([message_data])
             
-            result = await asyncio.to_thread(_sync_insert)
-            
-            if result.data and len(result.data) > 0:
-                record_id = result.data[0].get('id')
+            if rows:
+                record_id = rows[0].get('id')
                 self.logger.info(f"✅ 消息已保存到Supabase: id={record_id}, user_id={user_id}, sender={sender}")
                 return str(record_id)
             else:
@@ -146,6 +94,189 @@ class SupabaseMessageRepository:
             self.logger.error(f"❌ 保存消息到Supabase失败: {e}")
             return None
     
+    def _build_message_row(self, user_id: str, role_id: Optional[str], session_id: str,
+                           instructions: Optional[str] = None,
+                           bot_reply: Optional[str] = None,
+                           history: Optional[str] = None,
+                           model_name: Optional[str] = None,
+                           user_input: Optional[str] = None,
+                           round: Optional[int] = None,
+                           full_response_latency: Optional[float] = None,
+                           first_response_latency: Optional[float] = None,
+                           attempt_count: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """校验并构造 messages 表的一行数据；校验失败返回 None"""
+        # 数据验证和转换
+        if not user_id or not user_id.strip():
+            self.logger.error("❌ user_id 不能为空")
+            return None
+        # sender 参数仅用于兼容旧接口，入库时不再写入，也不做强校验
+        
+        # 轻量数据验证（兼容当前先写bot后补user的流程）
+        if round is not None:
+            try:
+                if int(round) <= 0:
+                    self.logger.error(f"❌ round 必须为正整数，当前值: {round}")
+                    return None
+            except Exception:
+                self.logger.error(f"❌ round 必须为整数，当前值: {round}")
+                return None
+        if user_input is None and bot_reply is None:
+            # 允许短暂不完整（例如先写bot_reply），但记录警告
+            self.logger.warning("⚠️ 本次写入未包含 user_input 或 bot_reply，可能为临时不完整行（将于后续补全）")
+        if user_input is not None and instructions is None:
+            # 用户输入通常伴随指令与历史，缺省并非致命，提醒优化
+            self.logger.debug("ℹ️ 用户输入未携带 instructions（允许，但建议补充以便复现）")
+        if bot_reply is not None and user_input is None and round is None:
+            # 允许 bot 先写，但建议尽快补充 round 以实现一轮一行管理
+            self.logger.debug("ℹ️ 检测到仅 bot_reply 写入且 round 缺失（允许短暂存在，建议后续补充 round 与 user_input）")
+        
+        # 构造消息数据
+        message_data = {
+            "user_id": str(user_id).strip(),
+            "role_id": str(role_id).strip() if role_id else None, 
+            "session_id": str(session_id).strip() if session_id else None
+            # timestamp 由数据库触发器自动设置为东八区时间
+        }
+        # 🆕 新字段写入逻辑：按需添加新字段
+        if instructions is not None:
+            message_data["instructions"] = instructions
+        if bot_reply is not None:
+            message_data["bot_reply"] = bot_reply
+        if history is not None:
+            message_data["history"] = history
+        if model_name is not None:
+            message_data["model_name"] = model_name
+        if user_input is not None:
+            message_data["user_input"] = user_input
+        if round is not None:
+            message_data["round"] = round
+        if full_response_latency is not None:
+            # 数据库字段为 Integer 类型，需将秒数四舍五入为整数
+            try:
+                # 确保是浮点数或数字
+                if isinstance(full_response_latency, (int, float)):
+                    message_data["full_response"] = int(builtins.round(float(full_response_latency)))
+                else:
+                     self.logger.warning(f"⚠️ full_response_latency 类型错误: {type(full_response_latency)}")
+                     message_data["full_response"] = None
+            except Exception as e:
+                self.logger.warning(f"⚠️ full_response_latency 转换整数失败: {full_response_latency}, error: {e}")
+                message_data["full_response"] = None
+        
+        # 🆕 新增字段：首响耗时（保留小数，存为 float）
+        if first_response_latency is not None:
+            try:
+                message_data["first_response_latency"] = float(first_response_latency)
+            except Exception:
+                self.logger.warning(f"⚠️ first_response_latency 转换失败: {first_response_latency}")
+
+        # 🆕 新增字段：尝试次数（整数）
+        if attempt_count is not None:
+            try:
+                message_data["attempt_count"] = int(attempt_count)
+            except Exception:
+                self.logger.warning(f"⚠️ attempt_count 转换失败: {attempt_count}")
+        
+        return message_data
+    
+    async def _insert_rows(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """一次请求插入多行（使用线程池避免阻塞主线程），返回按插入顺序排列的记录"""
+        client = self.supabase_manager.get_client()
+        
+        def _sync_insert():
+            return client.table(self.table_name).insert(rows).execute()
+        
+        result = await asyncio.to_thread(_sync_insert)
+        return result.data or []
+    
+    # ----------------------------
+    # 异步批量写入：多轮消息合并为一次 insert 请求
+    # ----------------------------
+    def _enqueue_row(self, message_data: Dict[str, Any], sender: str) -> asyncio.Future:
+        """将一行加入批量写入队列，返回在该行落库后完成的 Future（结果为记录ID或 None）"""
+        loop = asyncio.get_running_loop()
+        if self._row_queue is None:
+            self._row_queue = asyncio.Queue()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = loop.create_task(self._flush_loop())
+        fut = loop.create_future()
+        self._row_queue.put_nowait((message_data, sender, fut))
+        return fut
+    
+    async def _flush_loop(self) -> None:
+        """后台写入循环：攒够 BATCH_MAX_ROWS 行或等待满 BATCH_MAX_WAIT 秒即发起一次批量插入"""
+        queue = self._row_queue
+        while True:
+            batch = [await queue.get()]
+            try:
+                # 整个攒批过程共用一个定时器，不像 wait_for 那样每取一行新建一个 Task
+                async with _aio_timeout(self.BATCH_MAX_WAIT):
+                    while len(batch) < self.BATCH_MAX_ROWS:
+                        batch.append(await queue.get())
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self._write_batch(batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+    
+    async def _write_batch(self, batch: List[Any]) -> None:
+        """
+        批量插入：按字段集合分组，每组一次 insert（不补 NULL，未提供的列仍走数据库默认值）
+        仅当 PostgREST 明确拒绝整组请求（事务已回滚、没有写入任何行）时才逐行重试，
+        网络超时等无法确认是否已写入的错误不重试，避免重复插入
+        """
+        groups: Dict[frozenset, List[Any]] = {}
+        for item in batch:
+            groups.setdefault(frozenset(item[0]), []).append(item)
+        for group in groups.values():
+            record_ids = await self._write_group(group)
+            for (message_data, sender, fut), record_id in zip(group, record_ids):
+                if record_id:
+                    self.logger.debug(f"🔄 异步保存消息成功: id={record_id}, user_id={message_data.get('user_id')}, sender={sender}")
+                else:
+                    self.logger.warning(f"⚠️ 异步保存消息失败: session={message_data.get('session_id')}, sender={sender}")
+                if not fut.done():
+                    fut.set_result(record_id)
+    
+    async def _write_group(self, group: List[Any]) -> List[Optional[str]]:
+        """写入字段集合相同的一组行，返回与 group 一一对应的记录ID（失败或无法确认为 None）"""
+        try:
+            rows = await self._insert_rows([item[0] for item in group])
+        except Exception as e:
+            if _PostgrestAPIError is None or not isinstance(e, _PostgrestAPIError):
+                self.logger.error(f"❌ 批量保存消息失败（无法确认是否已写入，不重试）: {e}")
+                return [None] * len(group)
+            self.logger.warning(f"⚠️ 批量保存消息被拒绝，改为逐行写入: {e}")
+            record_ids = []
+            for message_data, _sender, _fut in group:
+                try:
+                    rows = await self._insert_rows([message_data])
+                    record_ids.append(str(rows[0].get('id')) if rows else None)
+                except Exception as row_err:
+                    self.logger.error(f"❌ 保存消息到Supabase失败: {row_err}")
+                    record_ids.append(None)
+            return record_ids
+        if len(rows) != len(group):
+            # 请求已成功，行已写入：不能再重试，只是无法把返回的ID对应到各行
+            self.logger.warning(f"⚠️ 批量插入返回 {len(rows)} 行，期望 {len(group)} 行，无法对应记录ID")
+            return [None] * len(group)
+        self.logger.info(f"✅ 批量保存 {len(group)} 条消息到Supabase")
+        return [str(row.get('id')) for row in rows]
+    
+    async def aclose(self) -> None:
+        """关闭前把队列中尚未落库的消息写完，并停止后台写入循环"""
+        if self._row_queue is not None and self._flusher is not None and not self._flusher.done():
+            await self._row_queue.join()
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+    
     async def get_messages_by_session(self, session_id: str, limit: int = 100) -> List[Dict[str, Any]]:
         """
         根据会话ID获取消息历史
@@ -292,7 +423,7 @@ class SupabaseMessageRepository:
                                                       round: Optional[int] = None,
                                                       full_response_latency: Optional[float] = None,
                                                       first_response_latency: Optional[float] = None,
-                                                      retry_attempt: Optional[int] = None) -> asyncio.Task:
+                                                      retry_attempt: Optional[int] = None) -> asyncio.Future:
         """
         异步保存用户消息（使用AI生成时的真实数据内容）
         
@@ -313,35 +444,28 @@ class SupabaseMessageRepository:
             retry_attempt: 尝试次数（对应 attempt_count）
             
         Returns:
-            asyncio.Task: 可以await的任务对象
+            asyncio.Future: 可以await的对象，落库后结果为记录ID（失败为 None）；
+            实际写入由后台批量合并执行
         """
-        async def _safe_save():
-            try:
-                result = await self.save_message(
-                    user_id=user_id,
-                    role_id=role_id,
-                    session_id=session_id,
-                    sender="user",
-                    # 🆕 新字段写入逻辑：透传到基础保存方法
-                    instructions=instructions,
-                    bot_reply=bot_reply,
-                    history=history,
-                    model_name=model_name,
-                    user_input=user_input,
-                    round=round,
-                    full_response_latency=full_response_latency,
-                    first_response_latency=first_response_latency,
-                    attempt_count=retry_attempt
-                )
-                
-                if result:
-                    self.logger.debug(f"🔄 异步保存用户消息成功: id={result}")
-                else:
-                    self.logger.warning(f"⚠️ 异步保存用户消息失败: session={session_id}")
-            except Exception as e:
-                self.logger.error(f"❌ 异步保存用户消息异常: {e}")
-        
-        return asyncio.create_task(_safe_save())
+        try:
+            message_data = self._build_message_row(
+                user_id=user_id, role_id=role_id, session_id=session_id,
+                # 🆕 新字段写入逻辑：透传到行构造
+                instructions=instructions, bot_reply=bot_reply, history=history,
+                model_name=model_name, user_input=user_input, round=round,
+                full_response_latency=full_response_latency,
+                first_response_latency=first_response_latency,
+                attempt_count=retry_attempt
+            )
+        except Exception as e:
+            self.logger.error(f"❌ 异步保存用户消息异常: {e}")
+            message_data = None
+        if message_data is None:
+            self.logger.warning(f"⚠️ 异步保存用户消息失败: session={session_id}")
+            fut = asyncio.get_running_loop().create_future()
+            fut.set_result(None)
+            return fut
+        return self._enqueue_row(message_data, "user")
     
     async def get_session_user_turn_count(self, session_id: str) -> int:
         """
@@ -419,10 +543,11 @@ class SupabaseMessageRepository:
     
     async def update_last_user_message_reply(self, session_id: str, 
                                             bot_reply: Optional[str] = None,
-                                            history: Optional[str] = None,
+                                            history: Optional[Union[str, List[Dict[str, Any]]]] = None,
                                             model_name: Optional[str] = None) -> bool:
         """
         更新会话中最新一条用户消息的回复相关字段（用于重新生成时覆盖旧 bot_reply/history/model）
+        history 可直接传消息列表：在写库线程中用 orjson 序列化一次，不占用事件循环
         """
         try:
             last_round_row = await self._get_last_round_row(session_id)
@@ -440,6 +565,15 @@ class SupabaseMessageRepository:
                 return True
             client = self.supabase_manager.get_client()
             def _sync_update():
+                history_value = payload.get("history")
+                if history_value is not None and not isinstance(history_value, str):
+                    try:
+                        payload["history"] = orjson.dumps(history_value).decode()
+                    except Exception as e:
+                        self.logger.warning(f"⚠️ 历史序列化失败，跳过 history 字段: session_id={session_id}, err={e}")
+                        del payload["history"]
+                        if not payload:
+                            return None
                 return client.table(self.table_name)\
                     .update(payload)\
                     .eq("id", msg_id)\
@@ -452,7 +586,7 @@ class SupabaseMessageRepository:
             return False
     
     def save_bot_message_async(self, user_id: str, role_id: Optional[str], 
-                              session_id: str, bot_reply: str) -> asyncio.Task:
+                              session_id: str, bot_reply: str) -> asyncio.Future:
         """
         异步保存机器人消息（不阻塞主流程）
         
@@ -463,23 +597,19 @@ class SupabaseMessageRepository:
             bot_reply: 机器人回复内容
             
         Returns:
-            asyncio.Task: 可以await的任务对象
+            asyncio.Future: 可以await的对象，落库后结果为记录ID（失败为 None）
         """
-        async def _safe_save():
-            try:
-                result = await self.save_message(
-                    user_id=user_id, 
-                    role_id=role_id, 
-                    session_id=session_id, 
-                    sender="bot",
-                    bot_reply=bot_reply
-                    # bot消息主要保存回复内容，其他字段使用默认的None值
-                )
-                if result:
-                    self.logger.debug(f"🔄 异步保存机器人消息成功: id={result}")
-                else:
-                    self.logger.warning(f"⚠️ 异步保存机器人消息失败: session={session_id}")
-            except Exception as e:
-                self.logger.error(f"❌ 异步保存机器人消息异常: {e}")
-        
-        return asyncio.create_task(_safe_save())
+        try:
+            # bot消息主要保存回复内容，其他字段使用默认的None值
+            message_data = self._build_message_row(
+                user_id=user_id, role_id=role_id, session_id=session_id, bot_reply=bot_reply
+            )
+        except Exception as e:
+            self.logger.error(f"❌ 异步保存机器人消息异常: {e}")
+            message_data = None
+        if message_data is None:
+            self.logger.warning(f"⚠️ 异步保存机器人消息失败: session={session_id}")
+            fut = asyncio.get_running_loop().create_future()
+            fut.set_result(None)
+            return fut
+        return self._enqueue_row(message_data, "bot")
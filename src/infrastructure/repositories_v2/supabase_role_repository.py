@@ -95,11 +95,12 @@ class SupabaseRoleRepository:
             # 获取所有角色
             all_roles = self.list_roles()
             
-            # 筛选包含指定标签的角色
+            # 筛选包含指定标签的角色：目标标签转为集合一次，每个角色只做一次 isdisjoint 判断
+            wanted_tags = frozenset(tags)
             filtered_roles = []
             for role in all_roles:
                 role_tags = role.get("tags", [])
-                if isinstance(role_tags, list) and any(tag in role_tags for tag in tags):
+                if isinstance(role_tags, list) and not wanted_tags.isdisjoint(role_tags):
                     filtered_roles.append(role)
             
             self.logger.info(f"✅ 标签筛选完成: tags={tags}, 匹配 {len(filtered_roles)} 个角色")
@@ -1,6 +1,7 @@
 import uuid
 import time
-from typing import Any, Dict, Optional
+import orjson
+from typing import Any, Dict, List, Mapping, Optional
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel, Field, field_validator
 
@@ -252,13 +253,13 @@ async def process_message(user_id: str, content: str, role_id: str = None) -> Di
          logger.debug(f"获取用户模型偏好失败: {e}")
 
     try:
-        # 使用流式生成并收集完整回复
-        reply = ""
+        # 使用流式生成并收集完整回复（分片收集后一次拼接，避免长回复反复重新分配字符串）
+        reply_chunks: List[str] = []
         used_instructions_meta: Dict[str, Any] = {}
         def _on_used_instructions(meta: Dict[str, Any]) -> None:
             try:
                 used_instructions_meta.clear()
-                if isinstance(meta, dict):
+                if isinstance(meta, Mapping):
                     used_instructions_meta.update(meta)
             except Exception:
                 pass
@@ -271,7 +272,8 @@ async def process_message(user_id: str, content: str, role_id: str = None) -> Di
             apply_enhancement=True,
             model_mode=model_mode
         ):
-            reply += chunk
+            reply_chunks.append(chunk)
+        reply = "".join(reply_chunks)
             
         # 🆕 AI生成完成后，获取实际使用的指令并重新保存用户消息（带指令 + 100%复现的history）
         if message_service.message_repository:
@@ -305,12 +307,11 @@ async def process_message(user_id: str, content: str, role_id: str = None) -> Di
                             constructed.extend(history or [])
                             final_messages = constructed
                         try:
-                            import json
-                            history_json_str = json.dumps(final_messages, ensure_ascii=False)
+                            history_json_str = orjson.dumps(final_messages).decode()
                         except Exception:
                             history_json_str = None
                         # 异步保存用户消息（不阻塞主流程）
-                        message_service.message_repository.save_user_message_with_real_instructions_async(
+                        message_service.save_user_round_async(
                             user_id=str(user_id),
                             role_id=str(role_id_for_save) if role_id_for_save else None,
                             session_id=session_id,
@@ -3,6 +3,7 @@
 处理购买积分、订单查询等支付相关回调
 """
 
+import functools
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from datetime import datetime
@@ -10,6 +11,33 @@ from datetime import datetime
 from .base_callback_handler import BaseCallbackHandler, robust_callback_handler
 
 
+# 套餐/支付方式键盘只取决于静态配置与少量参数，构建一次后缓存复用
+# （InlineKeyboardMarkup 为不可变对象，可在多次回调间安全共享）
+@functools.lru_cache(maxsize=8)
+def _package_selection_keyboard(return_callback: str) -> InlineKeyboardMarkup:
+    from src.utils.config.app_config import CREDIT_PACKAGES
+    keyboard = [
+        [InlineKeyboardButton(
+            f"{package_info['name']} - ¥{package_info['price']}",
+            callback_data=f"select_package_{package_id}"
+        )]
+        for package_id, package_info in CREDIT_PACKAGES.items()
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 返回个人中心", callback_data=return_callback)])
+    return InlineKeyboardMarkup(keyboard)
+
+
+@functools.lru_cache(maxsize=64)
+def _payment_method_keyboard(package_id: str) -> InlineKeyboardMarkup:
+    from src.utils.config.app_config import PAYMENT_METHODS
+    keyboard = [
+        [InlineKeyboardButton(f"💳 {method_name}", callback_data=f"buy_package_{method_id}_{package_id}")]
+        for method_id, method_name in PAYMENT_METHODS.items()
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 返回套餐选择", callback_data="buy_credits")])
+    return InlineKeyboardMarkup(keyboard)
+
+
 class PaymentCallbackHandler(BaseCallbackHandler):
     """支付回调处理器"""
     
@@ -80,20 +108,7 @@ class PaymentCallbackHandler(BaseCallbackHandler):
 
     def _create_package_selection_keyboard(self, return_callback: str = "back_to_profile"):
         """创建统一的套餐选择键盘"""
-        from src.utils.config.app_config import CREDIT_PACKAGES
-        keyboard = []
-        for package_id, package_info in CREDIT_PACKAGES.items():
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{package_info['name']} - ¥{package_info['price']}",
-                    callback_data=f"select_package_{package_id}"
-                )
-            ])
-        
-        keyboard.append([
-            InlineKeyboardButton("🔙 返回个人中心", callback_data=return_callback)
-        ])
-        return InlineKeyboardMarkup(keyboard)
+        return _package_selection_keyboard(return_callback)
     
     @robust_callback_handler
     async def handle_buy_credits_callback(self, query, context):
@@ -112,19 +127,7 @@ class PaymentCallbackHandler(BaseCallbackHandler):
         message = self._generate_credit_purchase_message(is_first_purchase)
         
         # 创建套餐选择按钮
-        from src.utils.config.app_config import CREDIT_PACKAGES
-        keyboard = []
-        for package_id, package_info in CREDIT_PACKAGES.items():
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{package_info['name']} - ¥{package_info['price']}",
-                    callback_data=f"select_package_{package_id}"
-                )
-            ])
-        
-        keyboard.append([InlineKeyboardButton("🔙 返回个人中心", callback_data="back_to_profile")])
-        
-        await self._safe_edit_message(query, message, InlineKeyboardMarkup(keyboard))
+        await self._safe_edit_message(query, message, self._create_package_selection_keyboard("back_to_profile"))
     
     @robust_callback_handler
     async def handle_package_selection(self, query, context, package_id: str):
@@ -149,20 +152,8 @@ class PaymentCallbackHandler(BaseCallbackHandler):
         message += f"💎 积分：{package_info['credits']}\n\n"
         message += "请选择支付方式："
         
-        # 创建支付方式选择按钮，callback_data包含套餐ID
-        from src.utils.config.app_config import PAYMENT_METHODS
-        keyboard = []
-        for method_id, method_name in PAYMENT_METHODS.items():
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"💳 {method_name}",
-                    callback_data=f"buy_package_{method_id}_{package_id}"
-                )
-            ])
-        
-        keyboard.append([InlineKeyboardButton("🔙 返回套餐选择", callback_data="buy_credits")])
-        
-        await self._safe_edit_message(query, message, InlineKeyboardMarkup(keyboard))
+        # 创建支付方式选择按钮，callback_data包含套餐ID（package_id 已校验属于 CREDIT_PACKAGES，缓存键有界）
+        await self._safe_edit_message(query, message, _payment_method_keyboard(package_id))
     
     @robust_callback_handler
     async def handle_package_purchase(self, query, context, method_id: str, package_id: str):
@@ -357,14 +348,20 @@ class PaymentCallbackHandler(BaseCallbackHandler):
     async def _process_payment_success_like_original(self, order_no: str, trade_no: str, order):
         """照抄原始项目的process_payment_success逻辑"""
         try:
+            # 检查用户首冲状态（须在更新订单前读取，且不走缓存）
+            user_id = order['user_id']
+            is_first_add = await self.payment_service.is_first_purchase(user_id, use_cache=False)
+
             # 更新订单状态为已支付（中间状态）
+            now_iso = datetime.utcnow().isoformat()
             await self.payment_service.payment_order_repo.update_by_order_id(
                 order_no, {
                     'status': 'paid',
-                    'paid_at': datetime.utcnow().isoformat(),
-                    'updated_at': datetime.utcnow().isoformat()
+                    'paid_at': now_iso,
+                    'updated_at': now_iso
                 }
             )
+            self.payment_service.invalidate_first_purchase_cache(user_id)
 
             # 获取积分包信息
             from src.utils.config.app_config import CREDIT_PACKAGES, FIRST_CHARGE_BONUS, REGULAR_CHARGE_BONUS
@@ -376,10 +373,6 @@ class PaymentCallbackHandler(BaseCallbackHandler):
                 self.logger.error(f"无效的积分包类型: {package_id}")
                 return False
 
-            # 检查用户首冲状态
-            user_id = order['user_id']
-            is_first_add = await self.payment_service.is_first_purchase(user_id)
-
             # 计算应发放的积分 - 照抄原始逻辑
             base_credits = order['points_awarded']
             bonus_credits = 0
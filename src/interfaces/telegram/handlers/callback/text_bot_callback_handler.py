@@ -1,5 +1,6 @@
 import logging
 import os
+from typing import Mapping
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 import uuid
 from telegram.ext import ContextTypes
@@ -204,7 +205,7 @@ class TextBotCallbackHandler(BaseCallbackHandler):
             def _on_used_instructions(meta: dict) -> None:
                 try:
                     used_instructions_meta.clear()
-                    if isinstance(meta, dict):
+                    if isinstance(meta, Mapping):
                         used_instructions_meta.update(meta)
                 except Exception as _e:
                     self.logger.debug(f"on_used_instructions 回调处理失败(重新生成): {_e}")
@@ -285,17 +286,12 @@ class TextBotCallbackHandler(BaseCallbackHandler):
                                             # 使用当前截断后的 history
                                             constructed.extend(history or [])
                                             final_messages = constructed
-                                        try:
-                                            import json
-                                            history_json_str = json.dumps(final_messages, ensure_ascii=False)
-                                        except Exception:
-                                            history_json_str = None
                                         
                                         # 覆盖最新一条用户消息的 bot_reply/history/model（不新增用户行）
                                         await self.message_service.message_repository.update_last_user_message_reply(
                                             session_id=session_id,
                                             bot_reply=self._safe_text_for_telegram(accumulated_text),
-                                            history=history_json_str,
+                                            history=final_messages,
                                             model_name=model_name
                                         )
                                         self.logger.info(f"🔄 已覆盖最新用户消息的回复(重新生成): session_id={session_id}")
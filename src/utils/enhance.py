@@ -1,6 +1,25 @@
 import os
 from typing import Tuple, Optional
 
+# 指令模板在模块加载时预先拆分为固定片段，渲染时直接拼接，无需解析任何模板语法
+# 前3轮对话的增强指令模板：片段依次夹着 system_instructions、user_context
+SYSTEM_INSTRUCTION_FRAGMENTS = ("##系统指令：以下为最高优先级指令。\n", "##用户指令:", "\n")
+# 第4轮及以后对话的持续指令模板：片段依次夹着 ongoing_instructions、user_context
+ONGOING_INSTRUCTION_FRAGMENTS = ("##系统指令：\n", "##用户指令:", "\n")
+
+
+def render_system_instruction(system_instructions: str, user_context: str) -> str:
+    """渲染前3轮对话的增强内容"""
+    head, user_head, tail = SYSTEM_INSTRUCTION_FRAGMENTS
+    return f"{head}{system_instructions}{user_head}{user_context}{tail}"
+
+
+def render_ongoing_instruction(ongoing_instructions: str, user_context: str) -> str:
+    """渲染第4轮及以后对话的增强内容"""
+    head, user_head, tail = ONGOING_INSTRUCTION_FRAGMENTS
+    return f"{head}{ongoing_instructions}{user_head}{user_context}{tail}"
+
+
 def enhance_user_input(original_content: str, instruction_type: str, user_context: Optional[str] = None) -> Tuple[str, Optional[str]]:
     """
     根据指令类型对用户输入进行增强，返回 (增强后的内容, 实际使用的指令文本或 None)
@@ -12,31 +31,12 @@ def enhance_user_input(original_content: str, instruction_type: str, user_contex
         user_context = original_content or ""
     
     if instruction_type == "system":
-        template = (
-            "##系统指令：以下为最高优先级指令。\n"
-            "{system_instructions}"
-            "##用户指令:{user_context}\n"
-        )
         instructions = os.getenv('SYSTEM_INSTRUCTIONS', '') or ''
-        enhanced_content = template.format(
-            user_context=user_context,
-            system_instructions=instructions
-        )
+        enhanced_content = render_system_instruction(instructions, user_context)
         return enhanced_content, (instructions or None)
     elif instruction_type == "ongoing":
-        template = (
-
-            "##系统指令：\n"
-            "{ongoing_instructions}"
-            "##用户指令:{user_context}\n"
-        )
         instructions = os.getenv('ONGOING_INSTRUCTIONS', '') or ''
-        enhanced_content = template.format(
-            user_context=user_context,
-            ongoing_instructions=instructions
-        )
+        enhanced_content = render_ongoing_instruction(instructions, user_context)
         return enhanced_content, (instructions or None)
     else:
         raise ValueError(f"不支持的指令类型: {instruction_type}")
-
-
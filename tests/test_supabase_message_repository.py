@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Supabase消息仓储批量写入测试
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+# 添加项目根目录到路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+pytest.importorskip("supabase")
+pytest.importorskip("async_timeout")
+
+from postgrest.exceptions import APIError
+from src.infrastructure.repositories_v2.supabase_message_repository import SupabaseMessageRepository
+
+
+class FakeInsert:
+    def __init__(self, client, rows):
+        self.client = client
+        self.rows = rows
+
+    def execute(self):
+        self.client.inserts.append(self.rows)
+        if self.client.errors:
+            raise self.client.errors.pop(0)
+        data = [{"id": self.client.next_id + i} for i in range(len(self.rows))]
+        self.client.next_id += len(self.rows)
+        if self.client.drop_rows:
+            data = data[:-1]
+        return type("Result", (), {"data": data})()
+
+
+class FakeClient:
+    def __init__(self, errors=None, drop_rows=False):
+        self.inserts = []
+        self.errors = list(errors or [])
+        self.drop_rows = drop_rows
+        self.next_id = 1
+
+    def table(self, name):
+        return self
+
+    def insert(self, rows):
+        return FakeInsert(self, rows)
+
+
+class FakeManager:
+    def __init__(self, client):
+        self.client = client
+
+    def get_client(self):
+        return self.client
+
+
+async def _save_rounds(repo, count, **extra):
+    futures = [
+        repo.save_user_message_with_real_instructions_async(
+            "u1", None, "sess_1", user_input=f"hi {i}", round=i + 1, **extra
+        )
+        for i in range(count)
+    ]
+    results = await asyncio.gather(*futures)
+    await repo.aclose()
+    return results
+
+
+def test_batch_groups_rows_by_columns_without_null_padding():
+    client = FakeClient()
+    repo = SupabaseMessageRepository(FakeManager(client))
+
+    async def run():
+        futures = [
+            repo.save_user_message_with_real_instructions_async("u1", None, "sess_1", user_input="a", round=1),
+            repo.save_user_message_with_real_instructions_async("u1", None, "sess_1", user_input="b", round=2, model_name="m"),
+            repo.save_user_message_with_real_instructions_async("u1", None, "sess_1", user_input="c", round=3),
+        ]
+        results = await asyncio.gather(*futures)
+        await repo.aclose()
+        return results
+
+    results = asyncio.run(run())
+
+    assert len(client.inserts) == 2
+    for rows in client.inserts:
+        assert len({frozenset(row) for row in rows}) == 1
+        assert all(value is not None for row in rows for key, value in row.items() if key != "role_id")
+    assert all(results)
+
+
+def test_successful_insert_with_unexpected_row_count_is_not_retried():
+    client = FakeClient(drop_rows=True)
+    repo = SupabaseMessageRepository(FakeManager(client))
+
+    results = asyncio.run(_save_rounds(repo, 3))
+
+    assert len(client.inserts) == 1
+    assert results == [None, None, None]
+
+
+def test_rejected_batch_is_retried_row_by_row():
+    client = FakeClient(errors=[APIError({"message": "rejected"})])
+    repo = SupabaseMessageRepository(FakeManager(client))
+
+    results = asyncio.run(_save_rounds(repo, 3))
+
+    assert [len(rows) for rows in client.inserts] == [3, 1, 1, 1]
+    assert all(results)
+
+
+def test_unconfirmed_failure_is_not_retried():
+    client = FakeClient(errors=[TimeoutError("read timeout")])
+    repo = SupabaseMessageRepository(FakeManager(client))
+
+    results = asyncio.run(_save_rounds(repo, 3))
+
+    assert len(client.inserts) == 1
+    assert results == [None, None, None]
+
+
+def test_flush_loop_caps_batches_and_closes_them_after_the_wait_window():
+    client = FakeClient()
+    repo = SupabaseMessageRepository(FakeManager(client))
+    repo.BATCH_MAX_ROWS = 2
+
+    async def run():
+        futures = [
+            repo.save_user_message_with_real_instructions_async("u1", None, "sess_1", user_input=f"hi {i}", round=i + 1)
+            for i in range(3)
+        ]
+        await asyncio.gather(*futures)
+        await asyncio.sleep(repo.BATCH_MAX_WAIT * 2)
+        late = repo.save_user_message_with_real_instructions_async("u1", None, "sess_1", user_input="late", round=4)
+        results = await asyncio.gather(*futures, late)
+        await repo.aclose()
+        return results
+
+    results = asyncio.run(run())
+
+    assert [len(rows) for rows in client.inserts] == [2, 1, 1]
+    assert all(results)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Upstash 会话存储批量追加测试
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+# 添加项目根目录到路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+httpx = pytest.importorskip("httpx")
+
+from src.infrastructure.redis.upstash_session_store import UpstashSessionStore
+
+
+class FakeRedis:
+    """按 pipeline 命令维护列表长度，可预设首次请求抛出的异常"""
+
+    def __init__(self, errors=None):
+        self.lists = {}
+        self.requests = []
+        self.errors = list(errors or [])
+
+    async def pipeline(self, commands, transaction=False):
+        self.requests.append(commands)
+        if self.errors:
+            raise self.errors.pop(0)
+        results = []
+        for command in commands:
+            if command[0] == "RPUSH":
+                self.lists[command[1]] = self.lists.get(command[1], 0) + 1
+                results.append({"result": self.lists[command[1]]})
+            elif command[0] == "LTRIM":
+                self.lists[command[1]] = min(self.lists[command[1]], -command[2])
+                results.append({"result": "OK"})
+            else:
+                results.append({"result": "OK"})
+        return results
+
+
+def _make_store(redis, max_items=150, retention=150):
+    store = UpstashSessionStore("http://upstash.test", "token")
+    store._pipeline = redis.pipeline
+    store.MAX_HISTORY_ITEMS = max_items
+    store.HISTORY_RETENTION_COUNT = retention
+    return store
+
+
+async def _append(store, session_ids):
+    results = await asyncio.gather(
+        *[
+            store.append_message_and_persist(session_id, {"message_id": str(i), "content": "hi"}, "u1", None)
+            for i, session_id in enumerate(session_ids)
+        ],
+        return_exceptions=True,
+    )
+    await store.aclose()
+    return results
+
+
+def test_concurrent_appends_share_one_pipeline():
+    redis = FakeRedis()
+    store = _make_store(redis)
+
+    results = asyncio.run(_append(store, ["s1", "s2", "s1"]))
+
+    assert len(redis.requests) == 1
+    assert results == [1, 1, 2]
+
+
+def test_lengths_after_trim_when_one_session_crosses_the_high_water_mark_twice():
+    redis = FakeRedis()
+    store = _make_store(redis, max_items=3, retention=2)
+    redis.lists[store._key_messages("s1")] = 2
+
+    results = asyncio.run(_append(store, ["s1", "s1", "s1"]))
+
+    # RPUSH 后分别为 3/4/5 条，截断到 2 条：前一条已被截掉，后两条位于下标 0、1
+    assert results == [0, 1, 2]
+    trims = [request for request in redis.requests if request[0][0] == "LTRIM"]
+    assert len(trims) == 1 and len(trims[0]) == 1
+    assert redis.lists[store._key_messages("s1")] == 2
+
+
+def test_unconfirmed_failure_fails_callers_without_retrying():
+    redis = FakeRedis(errors=[httpx.ReadTimeout("read timeout")])
+    store = _make_store(redis)
+
+    results = asyncio.run(_append(store, ["s1", "s2"]))
+
+    assert len(redis.requests) == 1
+    assert all(isinstance(result, httpx.ReadTimeout) for result in results)
+
+
+def test_batch_that_was_never_sent_is_retried_per_item():
+    redis = FakeRedis(errors=[httpx.ConnectError("connection refused")])
+    store = _make_store(redis)
+
+    results = asyncio.run(_append(store, ["s1", "s2"]))
+
+    assert [len(request) for request in redis.requests] == [8, 4, 4]
+    assert results == [1, 1]
+
+
+class FakeCommands:
+    """按单条命令维护字符串键，EVAL 按“键存在时 INCR”的语义模拟"""
+
+    def __init__(self):
+        self.values = {}
+        self.commands = []
+
+    async def cmd(self, *args):
+        self.commands.append(args)
+        command = args[0].lower()
+        if command == "setex":
+            self.values[args[1]] = str(args[3])
+            return {"result": "OK"}
+        if command == "get":
+            return {"result": self.values.get(args[1])}
+        if command == "eval":
+            key = args[3]
+            if key not in self.values:
+                return {"result": None}
+            self.values[key] = str(int(self.values[key]) + 1)
+            return {"result": int(self.values[key])}
+        raise AssertionError(f"unexpected command: {args}")
+
+
+def _make_command_store(redis):
+    store = UpstashSessionStore("http://upstash.test", "token")
+    store._cmd = redis.cmd
+    return store
+
+
+def test_daily_count_increments_from_zero_without_dropping_the_cache():
+    redis = FakeCommands()
+    store = _make_command_store(redis)
+
+    async def run():
+        await store.set_daily_message_count("u1", "20260101", 0, 60)
+        await store.incr_daily_message_count("u1", "20260101")
+        return await store.get_daily_message_count("u1", "20260101")
+
+    assert asyncio.run(run()) == 1
+    assert [command[0].lower() for command in redis.commands] == ["setex", "eval", "get"]
+
+
+def test_daily_count_increment_does_not_create_a_missing_key():
+    redis = FakeCommands()
+    store = _make_command_store(redis)
+
+    async def run():
+        await store.incr_daily_message_count("u1", "20260101")
+        return await store.get_daily_message_count("u1", "20260101")
+
+    assert asyncio.run(run()) is None
+    assert redis.values == {}